@@ -0,0 +1,128 @@
+// This file is part of ciqw
+// Copyright (C) 2021  Jean Schurger
+
+// This program is free software; you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation; either version 3 of the License, or
+// (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, write to the Free Software Foundation,
+// Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+// Keeps the Connect IQ compiler loaded in a JVM and runs its main()
+// for each request received on a Unix socket (Java 16 or later).
+// Request: one argument per line, ended by an empty line.
+// Reply: the compiler output, then "\0ciqw-exit <code>".
+
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.StandardProtocolFamily;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.net.UnixDomainSocketAddress;
+import java.nio.channels.Channels;
+import java.nio.channels.ServerSocketChannel;
+import java.nio.channels.SocketChannel;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.jar.JarFile;
+
+public class CompileServer {
+
+    static class ExitException extends SecurityException {
+        final int code;
+
+        ExitException(int code) {
+            this.code = code;
+        }
+    }
+
+    @SuppressWarnings("removal")
+    static void trapExit() {
+        // The compiler calls System.exit(), which must not end the
+        // server. Without a security manager the server exits and the
+        // client falls back to a new monkeyc process.
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override
+                public void checkExit(int status) {
+                    throw new ExitException(status);
+                }
+
+                @Override
+                public void checkPermission(java.security.Permission p) {
+                }
+            });
+        } catch (UnsupportedOperationException e) {
+            System.err.println("System.exit() can not be trapped.");
+        }
+    }
+
+    public static void main(String[] argv) throws Exception {
+        Path socket = Paths.get(argv[0]);
+        File jar = new File(argv[1]);
+        String mainClass;
+        try (JarFile jf = new JarFile(jar)) {
+            mainClass = jf.getManifest().getMainAttributes()
+                .getValue("Main-Class");
+        }
+        URLClassLoader loader = new URLClassLoader(
+            new URL[] {jar.toURI().toURL()},
+            CompileServer.class.getClassLoader());
+        Method main = loader.loadClass(mainClass)
+            .getMethod("main", String[].class);
+        trapExit();
+        Files.deleteIfExists(socket);
+        ServerSocketChannel server = ServerSocketChannel.open(
+            StandardProtocolFamily.UNIX);
+        server.bind(UnixDomainSocketAddress.of(socket));
+        PrintStream stdout = System.out;
+        PrintStream stderr = System.err;
+        while (true) {
+            try (SocketChannel client = server.accept()) {
+                BufferedReader in = new BufferedReader(new InputStreamReader(
+                    Channels.newInputStream(client), "UTF-8"));
+                List<String> args = new ArrayList<>();
+                String line;
+                while ((line = in.readLine()) != null && !line.isEmpty()) {
+                    args.add(line);
+                }
+                PrintStream reply = new PrintStream(
+                    Channels.newOutputStream(client), true, "UTF-8");
+                int code = 0;
+                System.setOut(reply);
+                System.setErr(reply);
+                try {
+                    main.invoke(null, (Object) args.toArray(new String[0]));
+                } catch (InvocationTargetException e) {
+                    if (e.getCause() instanceof ExitException) {
+                        code = ((ExitException) e.getCause()).code;
+                    } else {
+                        e.getCause().printStackTrace(reply);
+                        code = 1;
+                    }
+                } finally {
+                    System.setOut(stdout);
+                    System.setErr(stderr);
+                }
+                reply.print("\0ciqw-exit " + code + "\n");
+                reply.flush();
+            } catch (Exception e) {
+                e.printStackTrace();
+            }
+        }
+    }
+}
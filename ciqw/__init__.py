@@ -15,17 +15,85 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import importlib
 import logging
-logging.basicConfig()
-logging.getLogger().setLevel(logging.INFO)
-logging.getLogger().handlers[0].setFormatter(
-    logging.Formatter('%(message)s'))
-
-from ciqw.sdks import  install_sdk, install_sdkmanager, list_sdks, run_sdkmanager
-from ciqw.config import init, setup_logger
-from ciqw.run import build, run, auto, sim, release
-from ciqw.auth import login
-from ciqw.fonts_and_devices import install_fonts_and_devices, list_devices
-from ciqw.misc import doc, samples, samples_path
-
-setup_logger()
+import os
+import sys
+
+# Console scripts only import this module: each command loads its
+# implementation (and requests, pyquery...) when it is called.
+COMMANDS = {
+    'build': 'ciqw.run',
+    'auto': 'ciqw.run',
+    'run': 'ciqw.run',
+    'release': 'ciqw.run',
+    'sim': 'ciqw.run',
+    'test': 'ciqw.run',
+    'list_sdks': 'ciqw.sdks',
+    'install_sdk': 'ciqw.sdks',
+    'install_sdkmanager': 'ciqw.sdks',
+    'run_sdkmanager': 'ciqw.sdks',
+    'init': 'ciqw.config',
+    'genkey': 'ciqw.config',
+    'login': 'ciqw.auth',
+    'install_fonts_and_devices': 'ciqw.fonts_and_devices',
+    'list_devices': 'ciqw.fonts_and_devices',
+    'doc': 'ciqw.misc',
+    'samples': 'ciqw.misc',
+    'samples_path': 'ciqw.misc',
+    'sdk_store': 'ciqw.store',
+    'mirror': 'ciqw.mirror',
+    'cache': 'ciqw.build_cache',
+    'compile_server': 'ciqw.compiler',
+    'optimize_sdk': 'ciqw.cds',
+    'stats': 'ciqw.metrics',
+}
+
+
+def _setup_logging():
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger().handlers[0].setFormatter(
+        logging.Formatter('%(message)s'))
+    from ciqw.config import setup_logger
+    setup_logger()
+
+
+def _command(name):
+    def command():
+        from ciqw import trace
+        _setup_logging()
+        trace.setup(os.environ.get('CIQW_TRACE'))
+        try:
+            with trace.span(name.replace('_', '-')) as span:
+                try:
+                    return getattr(importlib.import_module(COMMANDS[name]),
+                                   name)()
+                except SystemExit as e:
+                    span['exit'] = e.code
+                    raise
+        finally:
+            trace.write()
+    command.__name__ = name
+    return command
+
+
+for _name in COMMANDS:
+    globals()[_name] = _command(_name)
+del _name
+
+
+def main():
+    # 'ciqw build ...' is 'ciqw-build ...', 'ciqw --trace FILE build ...'
+    # is 'CIQW_TRACE=FILE ciqw-build ...'.
+    names = sorted(n.replace('_', '-') for n in COMMANDS)
+    if len(sys.argv) > 2 and sys.argv[1] == '--trace':
+        os.environ['CIQW_TRACE'] = os.path.abspath(sys.argv.pop(2))
+        sys.argv.pop(1)
+    if len(sys.argv) < 2 or sys.argv[1] not in names:
+        print("usage: ciqw [--trace FILE] {%s} ..." % ",".join(names),
+              file=sys.stderr)
+        sys.exit(0 if sys.argv[1:] in (['-h'], ['--help']) else 2)
+    name = sys.argv.pop(1)
+    sys.argv[0] = 'ciqw-' + name
+    return _command(name.replace('-', '_'))()
@@ -18,8 +18,6 @@
 import logging
 import os
 import sys
-import requests
-import pyquery
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +27,8 @@ APIGCS = "https://api.gcs.garmin.com"
 
 
 def get_ticket(username, password):
+    import requests
+    import pyquery
     logger.info("Getting login page")
     signin = "https://sso.garmin.com/sso/signin?service=%s" % SERVICE
     s = requests.Session()
@@ -48,6 +48,7 @@ def get_ticket(username, password):
 
 
 def get_token(ticket):
+    import requests
     data = {'grant_type': 'service_ticket',
             'client_id': 'CIQ_SDK_MANAGER',
             'service_ticket': ticket,
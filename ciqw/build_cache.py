@@ -0,0 +1,287 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import sys
+import io
+import json
+import shutil
+import socket
+import zipfile
+import hashlib
+import filecmp
+import threading
+from ciqw import project
+from ciqw.config import read_config, read_json, write_json, CONFIG_DIR
+
+logger = logging.getLogger(__name__)
+
+# Matrix builds share hashes.json and stats.json between threads.
+_lock = threading.Lock()
+
+
+def get_cache_dir(config):
+    return config.get('build_cache') or os.path.join(CONFIG_DIR,
+                                                     'build-cache')
+
+
+def get_input_files(path='.', device=None):
+    # What the jungles make the build for 'device' read, of every
+    # product for a release, so that editing 'resources-fenix6' leaves
+    # the entries of other devices valid.
+    model = project.load(path)
+    files = set()
+    for d in [device] if device else model.products:
+        files.update(model.files(d))
+    return sorted(files)
+
+
+def _file_digest(filename, hashes):
+    # Hashes are remembered by size and mtime so unchanged files are
+    # not read again.
+    st = os.stat(filename)
+    key = os.path.abspath(filename)
+    known = hashes.get(key)
+    if known and known[:2] == [st.st_mtime_ns, st.st_size]:
+        return known[2]
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    hashes[key] = [st.st_mtime_ns, st.st_size, sha.hexdigest()]
+    return sha.hexdigest()
+
+
+def digest(config, files, args, key, sdk):
+    # 'args' are the monkeyc arguments without any local path, 'key'
+    # is only taken into account through its content.
+    hashes_filename = os.path.join(get_cache_dir(config), 'hashes.json')
+    hashes = read_json(hashes_filename, {})
+    before = dict(hashes)
+    sha = hashlib.sha256()
+    sha.update(json.dumps([args, sdk, config.get('version')]).encode())
+    sha.update(_file_digest(key, hashes).encode())
+    for f in files:
+        sha.update(("%s\0%s\0" % (f.replace(os.sep, '/'),
+                                  _file_digest(f, hashes))).encode())
+    if hashes != before:
+        # Merged into the current file, other threads may have added
+        # their own.
+        with _lock:
+            current = read_json(hashes_filename, {})
+            current.update((k, v) for k, v in hashes.items()
+                           if before.get(k) != v)
+            write_json(hashes_filename, current)
+    return sha.hexdigest()
+
+
+def _outputs(out):
+    directory = os.path.dirname(out) or '.'
+    name = os.path.basename(out)
+    return [os.path.join(directory, f) for f in os.listdir(directory)
+            if f.startswith(name) and os.path.isfile(
+                os.path.join(directory, f))]
+
+
+def _count(config, key):
+    stats_filename = os.path.join(get_cache_dir(config), 'stats.json')
+    with _lock:
+        stats = read_json(stats_filename, {})
+        stats[key] = stats.get(key, 0) + 1
+        write_json(stats_filename, stats)
+
+
+def _entry(config, digest):
+    return os.path.join(get_cache_dir(config), 'entries', digest)
+
+
+def _remote(config):
+    return (config.get('artifact_store') or '').strip().rstrip('/')
+
+
+def _remote_readonly(config):
+    return (config.get('artifact_store_readonly') or '').lower() in (
+        '1', 'yes', 'true', 'on')
+
+
+def _remote_url(config, digest):
+    return "%s/%s/%s.zip" % (_remote(config), digest[:2], digest)
+
+
+def _fetch_remote(config, digest):
+    # The shared store holds one zip per entry, either in a directory
+    # (NFS...) or behind plain HTTP GET/PUT.
+    remote = _remote(config)
+    url = _remote_url(config, digest)
+    entry = _entry(config, digest)
+    tmp = "%s.%d.%d.tmp" % (entry, os.getpid(), threading.get_ident())
+    try:
+        if '://' in remote:
+            from ciqw.net import session
+            req = session().get(url)
+            if req.status_code == 404:
+                return False
+            req.raise_for_status()
+            data = io.BytesIO(req.content)
+        elif os.path.exists(url):
+            data = url
+        else:
+            return False
+        with zipfile.ZipFile(data) as zf:
+            zf.extractall(tmp)
+        if os.path.exists(entry):
+            shutil.rmtree(tmp)
+        else:
+            os.replace(tmp, entry)
+        return True
+    except Exception as e:
+        logger.warning("Unable to fetch '%s': %s" % (url, e))
+        shutil.rmtree(tmp, ignore_errors=True)
+        return False
+
+
+def _push_remote(config, digest):
+    url = _remote_url(config, digest)
+    entry = _entry(config, digest)
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for f in sorted(os.listdir(entry)):
+            zf.write(os.path.join(entry, f), f)
+    try:
+        if '://' in _remote(config):
+            from ciqw.net import session
+            session().put(url, data=data.getvalue()).raise_for_status()
+        elif not os.path.exists(url):
+            os.makedirs(os.path.dirname(url), exist_ok=True)
+            tmp = "%s.%s.%d.%d.tmp" % (url, socket.gethostname(),
+                                       os.getpid(), threading.get_ident())
+            with open(tmp, 'wb') as f:
+                f.write(data.getvalue())
+            os.replace(tmp, url)
+    except Exception as e:
+        logger.warning("Unable to store '%s': %s" % (url, e))
+
+
+def restore(config, digest, out):
+    # Returns None on a miss, otherwise whether 'out' changed.
+    entry = _entry(config, digest)
+    if not os.path.isdir(entry):
+        _count(config, 'misses')
+        if not _remote(config):
+            return None
+        if not _fetch_remote(config, digest):
+            _count(config, 'remote_misses')
+            return None
+        _count(config, 'remote_hits')
+    else:
+        _count(config, 'hits')
+    os.utime(entry)
+    changed = False
+    directory = os.path.dirname(out)
+    name = os.path.basename(out)
+    for f in os.listdir(entry):
+        target = os.path.join(directory, name + f[len('output'):])
+        if not (os.path.exists(target) and
+                filecmp.cmp(os.path.join(entry, f), target, False)):
+            shutil.copy(os.path.join(entry, f), target)
+            changed = True
+    return changed
+
+
+def save(config, digest, out):
+    entry = _entry(config, digest)
+    tmp = "%s.%d.%d.tmp" % (entry, os.getpid(), threading.get_ident())
+    os.makedirs(tmp, exist_ok=True)
+    name = os.path.basename(out)
+    for f in _outputs(out):
+        # Stored under a neutral name, restored under the output name.
+        shutil.copy(f, os.path.join(
+            tmp, 'output' + os.path.basename(f)[len(name):]))
+    if os.path.exists(entry):
+        shutil.rmtree(tmp)
+    else:
+        os.replace(tmp, entry)
+    if _remote(config) and not _remote_readonly(config):
+        _push_remote(config, digest)
+    evict(config)
+
+
+def _entries(config):
+    entries_dir = os.path.join(get_cache_dir(config), 'entries')
+    if not os.path.isdir(entries_dir):
+        return []
+    entries = []
+    for entry in os.scandir(entries_dir):
+        if entry.is_dir() and not entry.name.endswith('.tmp'):
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+    return sorted(entries)
+
+
+def evict(config):
+    limit = int(config.get('build_cache_size') or 0) * 1024 * 1024
+    entries = _entries(config)
+    total = sum(size for _mtime, size, _path in entries)
+    while entries and total > limit:
+        _mtime, size, path = entries.pop(0)
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+    # Forget the hashes of deleted files, hashes.json would otherwise
+    # grow forever.
+    hashes_filename = os.path.join(get_cache_dir(config), 'hashes.json')
+    with _lock:
+        hashes = read_json(hashes_filename, {})
+        kept = dict((k, v) for k, v in hashes.items() if os.path.exists(k))
+        if len(kept) != len(hashes):
+            write_json(hashes_filename, kept)
+
+
+def enabled(config):
+    return int(config.get('build_cache_size') or 0) > 0
+
+
+def cache():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    config = read_config()
+    if command == 'stats':
+        entries = _entries(config)
+        stats = read_json(os.path.join(get_cache_dir(config),
+                                       'stats.json'), {})
+        hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+        logger.info("Cache: '%s'" % get_cache_dir(config))
+        logger.info("Entries: %d (%.1f MiB of %s MiB)" % (
+            len(entries), sum(e[1] for e in entries) / 1048576.,
+            config.get('build_cache_size')))
+        logger.info("Hits: %d, misses: %d (%.0f%% hit rate)" % (
+            hits, misses, 100. * hits / (hits + misses)
+            if hits + misses else 0))
+        if _remote(config):
+            hits = stats.get('remote_hits', 0)
+            misses = stats.get('remote_misses', 0)
+            logger.info("Shared store: '%s'%s" % (
+                _remote(config),
+                ' (read only)' if _remote_readonly(config) else ''))
+            logger.info("Shared hits: %d, misses: %d (%.0f%% hit rate)" % (
+                hits, misses, 100. * hits / (hits + misses)
+                if hits + misses else 0))
+    elif command == 'clear':
+        shutil.rmtree(get_cache_dir(config), ignore_errors=True)
+        logger.info("Cleared '%s'." % get_cache_dir(config))
+    else:
+        logger.error("Usage: ciqw-cache [stats|clear]")
+        sys.exit(1)
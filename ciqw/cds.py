@@ -0,0 +1,126 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from ciqw.config import read_config, CONFIG_DIR
+from ciqw import project
+
+logger = logging.getLogger(__name__)
+
+# Java class data sharing: a training compile records the classes the
+# SDK tools load into an archive the JVM maps at startup instead of
+# loading and verifying them again. monkeyc and monkeydo both run from
+# monkeybrains.jar, so one archive per SDK serves both.
+CDS_DIR = os.path.join(CONFIG_DIR, 'cds')
+
+
+def _archive(sdk_root):
+    return os.path.join(CDS_DIR, os.path.basename(sdk_root) + '.jsa')
+
+
+def _java():
+    # The archive is only valid for the JVM that created it.
+    java = shutil.which('java')
+    if not java:
+        return None
+    java = os.path.realpath(java)
+    return [java, os.stat(java).st_mtime]
+
+
+def java_env(sdk_root):
+    env = dict(os.environ)
+    archive = _archive(sdk_root)
+    if not os.path.exists(archive + '.json'):
+        return env
+    try:
+        if json.load(open(archive + '.json')) != _java():
+            return env
+    except ValueError:
+        return env
+    env['JAVA_TOOL_OPTIONS'] = " ".join(filter(None, [
+        env.get('JAVA_TOOL_OPTIONS'),
+        '-XX:SharedArchiveFile=%s' % archive, '-Xshare:auto']))
+    return env
+
+
+def _training_command(sdk_root, config, out):
+    command = [os.path.join(sdk_root, 'bin', 'monkeyc')]
+    samples = os.path.join(sdk_root, 'samples')
+    sample = None
+    if os.path.isdir(samples):
+        for f in sorted(os.listdir(samples)):
+            if os.path.exists(os.path.join(samples, f, 'manifest.xml')):
+                sample = os.path.join(samples, f)
+                break
+    if not sample or not os.path.exists(config['key']):
+        return command + ['--version']
+    jungles = [os.path.join(sample, j) for j in project.get_jungles(sample)]
+    if jungles:
+        command += ['--jungles'] + jungles
+    device = config['device']
+    products = project.get_products(sample)
+    if products and device not in products:
+        device = products[0]
+    return command + ['--device', device, '--output', out,
+                      '--private-key', config['key'], '--warn']
+
+
+def optimize(sdk_root):
+    config = read_config()
+    archive = _archive(sdk_root)
+    os.makedirs(CDS_DIR, exist_ok=True)
+    for f in (archive, archive + '.json'):
+        if os.path.exists(f):
+            os.unlink(f)
+    env = dict(os.environ)
+    env['JAVA_TOOL_OPTIONS'] = " ".join(filter(None, [
+        env.get('JAVA_TOOL_OPTIONS'), '-XX:ArchiveClassesAtExit=%s' %
+        archive]))
+    with tempfile.TemporaryDirectory() as tmp:
+        command = _training_command(sdk_root, config,
+                                    os.path.join(tmp, 'training.prg'))
+        logger.info("Calling '%s'." % " ".join(command))
+        start = time.time()
+        subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL).wait()
+    if not os.path.exists(archive):
+        logger.warning("The JVM did not create a class data archive "
+                       "(Java 13 or later is needed), nothing done.")
+        return False
+    with open(archive + '.json', 'w') as f:
+        json.dump(_java(), f)
+    logger.info("Created '%s' in %.1fs." % (archive, time.time() - start))
+    return True
+
+
+def optimize_sdk():
+    from ciqw.run import get_sdk_root
+    try:
+        config = read_config()
+        if len(sys.argv) == 2:
+            config['version'] = sys.argv[1]
+        optimize(get_sdk_root('monkeyc', config))
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
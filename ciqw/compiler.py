@@ -0,0 +1,168 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+from ciqw.config import read_config, read_json, write_json, CONFIG_DIR
+
+logger = logging.getLogger(__name__)
+
+SERVER_DIR = os.path.join(CONFIG_DIR, 'compile-server')
+SOCKET_FILENAME = os.path.join(SERVER_DIR, 'socket')
+STATE_FILENAME = os.path.join(SERVER_DIR, 'state.json')
+LOG_FILENAME = os.path.join(SERVER_DIR, 'server.log')
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'CompileServer.java')
+EXIT_MARKER = b'\0ciqw-exit '
+START_TIMEOUT = 60
+
+
+def _read_state():
+    return read_json(STATE_FILENAME, None)
+
+
+def _alive(state):
+    try:
+        os.kill(state['pid'], 0)
+    except OSError:
+        return False
+    return os.path.exists(SOCKET_FILENAME)
+
+
+def start(sdk_root):
+    jar = os.path.join(sdk_root, 'bin', 'monkeybrains.jar')
+    if not os.path.exists(jar):
+        raise Exception("No compiler found in '%s'." % sdk_root)
+    stop()
+    os.makedirs(SERVER_DIR, exist_ok=True)
+    # Same JVM options than the SDK monkeyc script.
+    command = ['java', '-Djava.security.manager=allow', '-Xms1g',
+               '-Dfile.encoding=UTF-8', '-Dapple.awt.UIElement=true',
+               SOURCE, SOCKET_FILENAME, jar]
+    logger.info("Calling '%s'." % " ".join(command))
+    p = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                         stdout=open(LOG_FILENAME, 'a'),
+                         stderr=subprocess.STDOUT, start_new_session=True)
+    state = {'pid': p.pid, 'sdk': sdk_root}
+    write_json(STATE_FILENAME, state)
+    deadline = time.time() + START_TIMEOUT
+    while not os.path.exists(SOCKET_FILENAME):
+        if p.poll() is not None or time.time() > deadline:
+            stop()
+            raise Exception("Compile server did not start, see '%s'." %
+                            LOG_FILENAME)
+        time.sleep(0.1)
+    logger.info("Compile server started for '%s'." % sdk_root)
+    return state
+
+
+def stop():
+    state = _read_state()
+    if state:
+        try:
+            os.kill(state['pid'], signal.SIGTERM)
+        except OSError:
+            pass
+    for f in (STATE_FILENAME, SOCKET_FILENAME):
+        if os.path.exists(f):
+            os.unlink(f)
+    return state
+
+
+def _absolute(args):
+    # The server JVM has its own working directory.
+    result = []
+    for i, arg in enumerate(args):
+        if (os.path.exists(arg) or
+                (i and args[i - 1] == '--output')):
+            arg = os.path.abspath(arg)
+        result.append(arg)
+    return result
+
+
+def submit(sdk_root, args, log=None):
+    # Returns monkeyc exit code, or None when no server is usable and
+    # the caller has to run monkeyc itself.
+    state = _read_state()
+    if not state or not _alive(state):
+        return None
+    if state['sdk'] != sdk_root:
+        logger.info("SDK changed, restarting compile server.")
+        try:
+            start(sdk_root)
+        except Exception as e:
+            logger.warning(str(e))
+            return None
+    out = log or sys.stdout
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(SOCKET_FILENAME)
+        s.sendall(("\n".join(_absolute(args)) + "\n\n").encode('utf-8'))
+        data = b''
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            if EXIT_MARKER not in data:
+                pos = data.rfind(b'\n') + 1
+                out.write(data[:pos].decode('utf-8', 'replace'))
+                out.flush()
+                data = data[pos:]
+    except OSError as e:
+        logger.warning("Compile server unavailable: %s" % e)
+        return None
+    finally:
+        s.close()
+    if EXIT_MARKER not in data:
+        # The compiler ended the server JVM.
+        logger.warning("Compile server died, see '%s'." % LOG_FILENAME)
+        stop()
+        return None
+    output, _sep, code = data.partition(EXIT_MARKER)
+    out.write(output.decode('utf-8', 'replace'))
+    out.flush()
+    return int(code.strip() or 1)
+
+
+def compile_server():
+    from ciqw.run import get_sdk_root
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    try:
+        if command == 'start':
+            start(get_sdk_root('monkeyc', read_config()))
+        elif command == 'stop':
+            if stop():
+                logger.info("Compile server stopped.")
+        elif command == 'status':
+            state = _read_state()
+            if state and _alive(state):
+                logger.info("Compile server running (pid %d) for '%s'." % (
+                    state['pid'], state['sdk']))
+            else:
+                logger.info("Compile server not running.")
+        else:
+            logger.error("Usage: ciqw-compile-server [start|stop|status]")
+            sys.exit(1)
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
@@ -16,22 +16,35 @@
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
 import logging
-import logging.config
 import os
 import sys
+import json
 import subprocess
 import configparser
+import threading
+from ciqw import trace
 
 logger = logging.getLogger(__name__)
 
 CONFIG_FILENAME = os.environ.get('CIQW_INI') or os.path.join(
     os.environ['HOME'], ".config", "ciqw", "config.ini")
+CONFIG_DIR = os.path.dirname(CONFIG_FILENAME)
 
 
 DEFAULT_CONFIG = {
     'key': os.path.join(os.environ['HOME'], ".config", "ciqw", "key.der"),
     'device': 'fenix6',
-    'flags': '--warn'}
+    'flags': '--warn',
+    'catalog_ttl': '86400',
+    'devices_ttl': '86400',
+    'concurrency': '8',
+    'retries': '3',
+    'build_cache_size': '512',
+    'optimize_sdk': 'no',
+    'auto_delay': '0.3',
+    'watcher': 'auto',
+    'poll_interval': '1',
+    'sim_timeout': '60'}
 
 if sys.platform.lower().startswith('darwin'):
     DEFAULT_CONFIG.update({
@@ -62,15 +75,67 @@ else:
     })
 
 
+_config = {}
+
+
+def _stamp():
+    try:
+        st = os.stat(CONFIG_FILENAME)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
 def read_config():
+    # Parsed once per process and again only when the file changes;
+    # 'CIQW_<KEY>' environment variables override any option, e.g.
+    # 'CIQW_DEVICE=fenix7 ciqw-build'. Callers get their own copy.
     if not os.path.exists(CONFIG_FILENAME):
         init()
+    stamp = _stamp()
+    if _config.get('stamp') != stamp:
+        with trace.span('read_config'):
+            cp = configparser.ConfigParser()
+            cp.read(CONFIG_FILENAME)
+            config = dict(cp['ciqw'])
+            for k, v in DEFAULT_CONFIG.items():
+                config.setdefault(k, v)
+        _config.update(stamp=stamp, config=config)
+    config = dict(_config['config'])
+    for k, v in os.environ.items():
+        if k.startswith('CIQW_') and k != 'CIQW_INI':
+            config[k[len('CIQW_'):].lower()] = v
+    return config
+
+
+def set_config(key, value):
+    # Only touches the file, environment overrides are not saved.
     cp = configparser.ConfigParser()
     cp.read(CONFIG_FILENAME)
-    config = dict(cp['ciqw'])
-    for k, v in DEFAULT_CONFIG.items():
-        config.setdefault(k, v)
-    return config
+    cp['ciqw'][key] = value
+    tmp = "%s.%d.tmp" % (CONFIG_FILENAME, os.getpid())
+    with open(tmp, 'w') as configfile:
+        cp.write(configfile)
+    os.replace(tmp, CONFIG_FILENAME)
+    _config.clear()
+
+
+def read_json(filename, default):
+    if os.path.exists(filename):
+        try:
+            return json.load(open(filename))
+        except ValueError:
+            logger.warning("Ignoring corrupted '%s'." % filename)
+    return default
+
+
+def write_json(filename, data, **kwargs):
+    # Atomic, and safe from concurrent threads and processes.
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmp, filename)
 
 
 def init():
@@ -118,6 +183,7 @@ def setup_logger():
 
     if os.path.exists(CONFIG_FILENAME):
         try:
+            import logging.config
             logging.config.fileConfig(CONFIG_FILENAME)
         except Exception:
             pass
@@ -125,13 +191,16 @@ def setup_logger():
 
 def _genkey(der):
     pem = der.replace('.der', '.pem')
-    subprocess.Popen(["openssl", "genrsa", "-out", pem, "4096"],
-                     stdout=subprocess.DEVNULL,
-                     stderr=subprocess.DEVNULL).wait()
-    subprocess.Popen(["openssl", "pkcs8", "-topk8", "-inform", "PEM",
-                      "-outform", "DER",
-                      "-in", pem,
-                      "-out", der, "-nocrypt"]).wait()
+    with trace.span('genkey') as span:
+        span['genrsa'] = subprocess.Popen(
+            ["openssl", "genrsa", "-out", pem, "4096"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL).wait()
+        span['pkcs8'] = subprocess.Popen(
+            ["openssl", "pkcs8", "-topk8", "-inform", "PEM",
+             "-outform", "DER",
+             "-in", pem,
+             "-out", der, "-nocrypt"]).wait()
 
 
 def genkey():
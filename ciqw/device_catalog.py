@@ -0,0 +1,95 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import json
+import time
+import sqlite3
+import contextlib
+from ciqw.config import CONFIG_DIR
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILENAME = os.path.join(CONFIG_DIR, 'devices.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    part_number TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    display_name TEXT,
+    device_group TEXT,
+    last_update_time TEXT,
+    data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS devices_name ON devices (name);
+CREATE INDEX IF NOT EXISTS devices_group ON devices (device_group);
+CREATE INDEX IF NOT EXISTS devices_updated ON devices (last_update_time);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _connect():
+    # To be closed by the caller, 'with db:' only commits. The schema
+    # script is idempotent: an empty file, left by an interrupted or
+    # concurrent first run, gets its tables.
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    db = sqlite3.connect(CATALOG_FILENAME)
+    db.executescript(SCHEMA)
+    return db
+
+
+def refreshed():
+    if not os.path.exists(CATALOG_FILENAME):
+        return 0
+    with contextlib.closing(_connect()) as db:
+        row = db.execute(
+            "SELECT value FROM meta WHERE key = 'refreshed'").fetchone()
+    return float(row[0]) if row else 0
+
+
+def store(devices):
+    with contextlib.closing(_connect()) as db, db:
+        db.execute("DELETE FROM devices")
+        db.executemany(
+            "INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?)",
+            [(d['partNumber'], d['name'], d.get('displayName'),
+              d.get('group'), d.get('lastUpdateTime'), json.dumps(d))
+             for d in devices])
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('refreshed', ?)",
+                   (str(time.time()),))
+
+
+def query(group=None, name=None, part_number=None, updated_since=None):
+    where, args = [], []
+    if group:
+        where.append("device_group LIKE ?")
+        args.append('%' + group + '%')
+    if name:
+        where.append("(name LIKE ? OR display_name LIKE ?)")
+        args.extend(['%' + name + '%'] * 2)
+    if part_number:
+        where.append("part_number LIKE ?")
+        args.append(part_number + '%')
+    if updated_since:
+        where.append("last_update_time >= ?")
+        args.append(updated_since)
+    sql = "SELECT data FROM devices"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY last_update_time, name"
+    with contextlib.closing(_connect()) as db:
+        return [json.loads(row[0]) for row in db.execute(sql, args)]
@@ -0,0 +1,162 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import stat
+import shutil
+import zlib
+import zipfile
+import concurrent.futures
+from ciqw import store as blob_store
+
+logger = logging.getLogger(__name__)
+
+# Below that amount of uncompressed data, forking workers costs more
+# than it saves.
+PARALLEL_THRESHOLD = 16 * 1024 * 1024
+
+
+def _member_path(target, name):
+    parts = [p for p in name.replace('\\', '/').split('/')
+             if p not in ('', '.', '..')]
+    return os.path.join(target, *parts) if parts else None
+
+
+def _is_exec(info, exec_dirs):
+    if (info.external_attr >> 16) & (stat.S_IXUSR | stat.S_IXGRP |
+                                     stat.S_IXOTH):
+        return True
+    return info.filename.replace('\\', '/').split('/')[0] in exec_dirs
+
+
+def _crc32(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _up_to_date(info, path):
+    try:
+        if os.stat(path).st_size != info.file_size:
+            return False
+    except OSError:
+        return False
+    return _crc32(path) == info.CRC
+
+
+def _extract_member(zf, info, path, exec_dirs, store=None):
+    executable = _is_exec(info, exec_dirs)
+    if store:
+        with zf.open(info) as src:
+            digest = blob_store.add(store, src, executable)
+        blob_store.link(blob_store.blob_path(store, digest, executable), path)
+        return (blob_store.index_key(info), [digest, executable])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zf.open(info) as src, open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    if executable:
+        os.chmod(path, os.stat(path).st_mode |
+                 stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def _extract_members(archive, target, names, exec_dirs, store=None):
+    entries = []
+    with zipfile.ZipFile(archive) as zf:
+        for name in names:
+            info = zf.getinfo(name)
+            entries.append(_extract_member(
+                zf, info, _member_path(target, name), exec_dirs, store))
+    return entries
+
+
+def _link_known(store, index, todo, exec_dirs):
+    # Members already in the store are materialized without reading
+    # the archive.
+    missing = []
+    linked = 0
+    for info, path in todo:
+        entry = index.get(blob_store.index_key(info))
+        blob = entry and blob_store.blob_path(store, *entry)
+        if blob and entry[1] == _is_exec(info, exec_dirs) and \
+                os.path.exists(blob):
+            blob_store.link(blob, path)
+            linked += 1
+        else:
+            missing.append((info, path))
+    return missing, linked
+
+
+def _split(members, count):
+    buckets = [[0, []] for _ in range(count)]
+    for info in sorted(members, key=lambda i: i.compress_size,
+                       reverse=True):
+        bucket = min(buckets, key=lambda b: b[0])
+        bucket[0] += info.compress_size + 1
+        bucket[1].append(info.filename)
+    return [names for _size, names in buckets if names]
+
+
+def extract(archive, target, exec_dirs=('bin',), processes=None,
+            store=None):
+    # 'archive' is either a file name or a seekable file object, only
+    # the former can be shared with worker processes. With a 'store',
+    # files are kept in that content addressed store and hardlinked
+    # into 'target'.
+    with zipfile.ZipFile(archive) as zf:
+        todo = []
+        skipped = 0
+        for info in zf.infolist():
+            path = _member_path(target, info.filename)
+            if not path:
+                continue
+            if info.is_dir():
+                os.makedirs(path, exist_ok=True)
+            elif _up_to_date(info, path):
+                skipped += 1
+            else:
+                todo.append((info, path))
+        if skipped:
+            logger.info("%d files already extracted in '%s'." % (
+                skipped, target))
+        count = len(todo)
+        if store:
+            todo, linked = _link_known(store, blob_store.load_index(store),
+                                       todo, exec_dirs)
+            if linked:
+                logger.info("%d files linked from store '%s'." % (
+                    linked, store))
+        if processes is None:
+            processes = os.cpu_count() or 1
+        size = sum(info.file_size for info, _path in todo)
+        if (not isinstance(archive, str) or processes < 2 or
+                len(todo) < 2 or size < PARALLEL_THRESHOLD):
+            entries = [_extract_member(zf, info, path, exec_dirs, store)
+                       for info, path in todo]
+            todo = []
+    if todo:
+        chunks = _split([info for info, _path in todo],
+                        min(processes, len(todo)))
+        with concurrent.futures.ProcessPoolExecutor(len(chunks)) as pool:
+            futures = [pool.submit(_extract_members, archive, target, names,
+                                   exec_dirs, store) for names in chunks]
+            entries = [e for f in futures for e in f.result()]
+    if store:
+        blob_store.update_index(store, dict(entries))
+    return count
@@ -18,16 +18,25 @@
 import logging
 import os
 import sys
-import zipfile
-import requests
+import json
+import time
+import shutil
+import argparse
+import threading
+import concurrent.futures
+from ciqw import device_catalog, project, metrics
 from ciqw.auth import _get_access_token
+from ciqw.config import read_config, read_json, write_json, CONFIG_DIR
+from ciqw.net import session, endpoint, get_mirror, retry, \
+    download_and_extract
 
 logger = logging.getLogger(__name__)
 
 SGC = "https://services.garmin.com"
-APIGCS = "https://api.gcs.garmin.com"
+SYNC_INDEX_FILENAME = os.path.join(CONFIG_DIR, 'devices-sync.json')
 
-SSL_VERIFY = not sys.platform.lower().startswith('darwin')
+# Matrix builds install the devices they miss from several threads.
+_ensure_lock = threading.Lock()
 
 # Function hidden here, not used
 # def get_customer_account(token):
@@ -41,129 +50,355 @@ SSL_VERIFY = not sys.platform.lower().startswith('darwin')
 # get_customer_account(token)
 
 
+def get_devices_root():
+    if sys.platform.lower().startswith('darwin'):
+        return os.path.join(os.getenv('HOME'), 'Library',
+                            'Application Support',
+                            'Garmin', 'ConnectIQ', 'Devices')
+    return os.path.join(os.getenv('HOME'), '.Garmin',
+                        'ConnectIQ', 'Devices')
+
+
+def get_fonts_root():
+    if sys.platform.lower().startswith('darwin'):
+        return os.path.join(os.getenv('HOME'), 'Library',
+                            'Application Support',
+                            'Garmin', 'ConnectIQ', 'Fonts')
+    return os.path.join(os.getenv('HOME'), '.Garmin',
+                        'ConnectIQ', 'Fonts')
+
+
 def get_device_list(token):
     headers = {'accept': 'application/json',
                'authorization': 'Bearer %s' % token}
-    req = requests.get(
-        APIGCS + "/ciq-product-onboarding/devices",
-        headers=headers, verify=SSL_VERIFY)
-    return req.json()
+    req = session().get(
+        endpoint('apigcs', "/ciq-product-onboarding/devices",
+                 "/ciq-product-onboarding/devices.json"),
+        headers=headers)
+    req.raise_for_status()
+    devices = req.json()
+    device_catalog.store(devices)
+    return devices
 
 
 def get_device_zip(token, device):
     headers = {'accept': 'application/json',
                'authorization': 'Bearer %s' % token}
-    req = requests.get(
-        APIGCS +
-        "/ciq-product-onboarding/devices/%s/ciqInfo" % device,
-        headers=headers, verify=SSL_VERIFY)
+    req = session().get(
+        endpoint('apigcs',
+                 "/ciq-product-onboarding/devices/%s/ciqInfo" % device),
+        headers=headers)
     return req.content
 
 
 def get_font_list(token):
     headers = {'accept': 'application/json',
                'authorization': 'Bearer %s' % token}
-    req = requests.get(
-        APIGCS + "/ciq-product-onboarding/fonts",
-        headers=headers, verify=SSL_VERIFY)
+    req = session().get(
+        endpoint('apigcs', "/ciq-product-onboarding/fonts",
+                 "/ciq-product-onboarding/fonts.json"),
+        headers=headers)
     return req.json()
 
 
-def install_fonts_and_devices():
+def _require_token():
     token = _get_access_token()
-    if not token:
+    if not token and not get_mirror():
         logger.error("You need to login to install fonts and devices")
         sys.exit(1)
-    _install_fonts_and_devices(token)
+    return token
 
 
-def list_devices():
-    token = _get_access_token()
-    if not token:
-        logger.error("You need to login to install fonts and devices")
+def install_fonts_and_devices():
+    parser = argparse.ArgumentParser(
+        prog='ciqw-install-fonts-and-devices',
+        description="Install the Connect IQ fonts and devices.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only show what would be installed or removed")
+    parser.add_argument('--manifest', nargs='?', const='.', metavar='PATH',
+                        help="only the products of the app in PATH "
+                        "(default: current directory) and their fonts")
+    args = parser.parse_args()
+    names = None
+    if args.manifest:
+        try:
+            names = project.get_products(args.manifest)
+        except Exception as e:
+            logger.error(str(e))
+            sys.exit(1)
+    failures = _install_fonts_and_devices(
+        _require_token(), dry_run=args.dry_run, names=names)
+    if failures:
+        logger.error("Failed to install: %s." % ", ".join(failures))
         sys.exit(1)
-    _list_devices(token)
 
 
-def _install_fonts_and_devices(token):
-    _install_fonts(token)
-    _install_devices(token)
+def ensure_devices(names):
+    # Called before building: installs the devices (and the fonts they
+    # use) that are missing, without any network access otherwise.
+    with _ensure_lock:
+        _ensure_devices(names)
 
 
-def _install_fonts(token):
-    fonts_root = os.path.join(os.getenv('HOME'), '.Garmin',
-                              'ConnectIQ', 'Fonts')
-    if sys.platform.lower().startswith('darwin'):
-        fonts_root = os.path.join(os.getenv('HOME'), 'Library',
-                                  'Application Support',
-                                  'Garmin', 'ConnectIQ', 'Fonts')
+def _ensure_devices(names):
+    devices_root = get_devices_root()
+    missing = [n for n in names
+               if not os.path.isdir(os.path.join(devices_root, n))]
+    if not missing:
+        return
+    token = _get_access_token()
+    if not token and not get_mirror():
+        logger.warning("Device(s) %s not installed and not logged in." %
+                       ", ".join(missing))
+        return
+    logger.info("Installing missing device(s): %s." % ", ".join(missing))
+    failures = _install_fonts_and_devices(token, names=missing)
+    if failures:
+        raise Exception("Failed to install: %s." % ", ".join(failures))
+
+
+def list_devices():
+    parser = argparse.ArgumentParser(
+        prog='ciqw-list-devices',
+        description="List the Connect IQ devices.")
+    parser.add_argument('--refresh', action='store_true',
+                        help="update the local catalog first")
+    parser.add_argument('--group')
+    parser.add_argument('--name', help="part of the name")
+    parser.add_argument('--part-number')
+    parser.add_argument('--updated-since', metavar='YYYY-MM-DD')
+    installed = parser.add_mutually_exclusive_group()
+    installed.add_argument('--installed', action='store_const',
+                           dest='installed', const=True)
+    installed.add_argument('--not-installed', action='store_const',
+                           dest='installed', const=False)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    ttl = int(read_config().get('devices_ttl') or 0)
+    if args.refresh or time.time() - device_catalog.refreshed() >= ttl:
+        import requests
+        token = _get_access_token()
+        if token or get_mirror():
+            try:
+                get_device_list(token)
+            except (requests.RequestException, ValueError) as e:
+                if not device_catalog.refreshed():
+                    raise
+                logger.warning("Unable to refresh the device list (%s), "
+                               "using the cached one." % e)
+        elif device_catalog.refreshed():
+            logger.warning("Not logged in, using the cached device list.")
+        else:
+            _require_token()
+    _list_devices(args)
+
+
+def _install_fonts_and_devices(token, dry_run=False, names=None):
+    # With 'names', only those devices and the fonts they reference are
+    # installed, and nothing is removed. Returns what failed.
+    failures = _install_devices(token, dry_run, names)
+    fonts = None
+    if names is not None:
+        fonts = set()
+        for name in names:
+            fonts.update(_get_device_fonts(name))
+    return failures + _install_fonts(token, dry_run, fonts)
+
+
+def _install_all(kind, items, fct, *args, done=None):
+    # One item failing, even after retries, does not stop the others.
+    # 'done' is called from this thread for every installed item.
+    config = read_config()
+    retries = int(config.get('retries') or 1)
+    failures = []
+    size = 0
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(
+            int(config.get('concurrency') or 1)) as pool:
+        futures = dict((pool.submit(retry, retries, fct, *(args + (item,))),
+                        item) for item in items)
+        for future in concurrent.futures.as_completed(futures):
+            item = futures[future]
+            try:
+                size += future.result() or 0
+            except Exception as e:
+                logger.error("Unable to install %s '%s': %s" % (
+                    kind, item['name'], e))
+                failures.append("%s '%s'" % (kind, item['name']))
+            else:
+                if done:
+                    done(item)
+    if items:
+        metrics.record('install', what=kind, items=len(items),
+                       failures=len(failures), bytes=size,
+                       seconds=round(time.time() - start, 3))
+    return failures
+
+
+def _install_font(token, fonts_root, font):
+    md5_filename = os.path.join(fonts_root, "%s.md5" % font['name'])
+    headers = {'authorization': 'Bearer %s' % token,
+               'accept': '*/*'}
+    logger.info("Downloading font '%s'." % font['name'])
+    size = download_and_extract(
+        endpoint('apigcs',
+                 "/ciq-product-onboarding/fonts/font?fontName=%s" %
+                 font['name'],
+                 "/ciq-product-onboarding/fonts/font/%s" %
+                 font['name']),
+        fonts_root, headers, merge=True)
+    open(md5_filename, "w").write(font['fontHash'])
+    return size
+
+
+def _get_device_fonts(name):
+    # Font names are found among the strings of the device definition,
+    # without depending on the exact layout of those files.
+    strings = set()
+
+    def walk(data):
+        if isinstance(data, dict):
+            for value in data.values():
+                walk(value)
+        elif isinstance(data, list):
+            for value in data:
+                walk(value)
+        elif isinstance(data, str):
+            strings.add(os.path.splitext(os.path.basename(data))[0])
+
+    device_path = os.path.join(get_devices_root(), name)
+    for f in ('compiler.json', 'simulator.json'):
+        if os.path.exists(os.path.join(device_path, f)):
+            try:
+                walk(json.load(open(os.path.join(device_path, f))))
+            except ValueError:
+                logger.warning("Unable to parse '%s'." %
+                               os.path.join(device_path, f))
+    return strings
+
+
+def _install_fonts(token, dry_run=False, names=None):
+    fonts_root = get_fonts_root()
     os.makedirs(fonts_root, exist_ok=True)
+    fonts = []
     for font in get_font_list(token):
+        if names is not None and font['name'] not in names:
+            continue
         font_filename = os.path.join(fonts_root, "%s.cft" % font['name'])
         md5_filename = os.path.join(fonts_root, "%s.md5" % font['name'])
         if os.path.exists(md5_filename):
             md5 = open(md5_filename).read().strip()
             if os.path.exists(font_filename) and md5 == font['fontHash']:
                 continue
-        open(md5_filename, "w").write(font['fontHash'])
-        headers = {'authorization': 'Bearer %s' % token,
-                   'accept': '*/*'}
-        req = requests.get(
-            APIGCS +
-            "/ciq-product-onboarding/fonts/font?fontName=%s" % font['name'],
-            headers=headers, verify=SSL_VERIFY)
-        logger.info("Downloading font '%s'." % font['name'])
-        open('%s.zip' % font_filename, "wb").write(req.content)
-        zf = zipfile.ZipFile('%s.zip' % font_filename)
-        zf.extractall(fonts_root)
-        os.unlink('%s.zip' % font_filename)
-
-
-def _install_devices(token):
-    devices_root = os.path.join(os.getenv('HOME'), '.Garmin',
-                                'ConnectIQ', 'Devices')
-    if sys.platform.lower().startswith('darwin'):
-        devices_root = os.path.join(os.getenv('HOME'), 'Library',
-                                    'Application Support',
-                                    'Garmin', 'ConnectIQ', 'Devices')
-    os.makedirs(devices_root, exist_ok=True)
-    for device in get_device_list(token):
-        # {'deviceUuid': 'b957e0db-67bb-4b6f-9aa2-426efcbe46fe',
-        # 'partNumber': '006-B2859-00',
-        # 'name': 'descentmk1',
-        # 'productInfoFileExists': True,
-        # 'ciqInfoFileExists': True,
-        # 'upcoming': False,
-        # 'productInfoHash': 'c79e0b7fee6d01b0d47757cf7ad587e5',
-        # 'ciqInfoHash': 'c96d495c2b8512a4e3c0c504d6f936a2',
-        # 'group': 'Watches/Wearables',
-        # 'displayName': 'Descent™ Mk1',
-        # 'lastUpdateTime': '2020-08-19 17:16:16'}
-        device_path = os.path.join(devices_root, device['name'])
-        if not os.path.exists(device_path):
-            headers = {'accept': '*/*',
-                       'authorization': 'Bearer %s' % token}
-            req = requests.get(
-                APIGCS +
-                "/ciq-product-onboarding/devices/%s/ciqInfo" %
-                device['partNumber'],
-                headers=headers, verify=SSL_VERIFY)
-            logger.info("Downloading device '%s'." % device['name'])
-            open(device_path + ".zip", "wb").write(req.content)
-            zf = zipfile.ZipFile(device_path + ".zip")
-            zf.extractall(device_path)
-            os.unlink(device_path + ".zip")
-
-
-def _list_devices(token):
-    devices_root = os.path.join(os.getenv('HOME'), '.Garmin',
-                                'ConnectIQ', 'Devices')
-    if sys.platform.lower().startswith('darwin'):
-        devices_root = os.path.join(os.getenv('HOME'), 'Library',
-                                    'Application Support',
-                                    'Garmin', 'ConnectIQ', 'Devices')
+        fonts.append(font)
+    if dry_run:
+        for font in fonts:
+            logger.info("+ font %s" % font['name'])
+        return []
+    return _install_all('font', fonts, _install_font, token, fonts_root)
+
+
+def _read_sync_index():
+    return read_json(SYNC_INDEX_FILENAME, {})
+
+
+def _write_sync_index(index):
+    write_json(SYNC_INDEX_FILENAME, index, indent=1, sort_keys=True)
+
+
+def _sync_entry(device):
+    return dict((k, device.get(k)) for k in (
+        'partNumber', 'ciqInfoHash', 'productInfoHash', 'lastUpdateTime'))
+
+
+def _device_delta(index, devices, devices_root):
+    # Devices not in the index (installed by hand or by the SDK
+    # manager) are fetched again once to learn their hashes, the ones
+    # gone upstream are only removed if ciqw installed them.
+    added, changed = [], []
+    for device in devices:
+        entry = index.get(device['name'])
+        if not os.path.exists(os.path.join(devices_root, device['name'])):
+            added.append(device)
+        elif not entry or any(entry.get(k) != device.get(k) for k in (
+                'ciqInfoHash', 'productInfoHash')):
+            changed.append(device)
+    names = set(d['name'] for d in devices)
+    removed = sorted(name for name in index if name not in names)
+    return added, changed, removed
+
+
+def _install_device(token, devices_root, device):
+    headers = {'accept': '*/*',
+               'authorization': 'Bearer %s' % token}
+    logger.info("Downloading device '%s'." % device['name'])
+    return download_and_extract(
+        endpoint('apigcs',
+                 "/ciq-product-onboarding/devices/%s/ciqInfo" %
+                 device['partNumber']),
+        os.path.join(devices_root, device['name']), headers)
+
+
+def _install_devices(token, dry_run=False, names=None):
+    devices_root = get_devices_root()
     os.makedirs(devices_root, exist_ok=True)
-    for device in sorted(get_device_list(token), key=lambda d: d['lastUpdateTime']):
+    # Each device looks like:
+    # {'deviceUuid': 'b957e0db-67bb-4b6f-9aa2-426efcbe46fe',
+    # 'partNumber': '006-B2859-00',
+    # 'name': 'descentmk1',
+    # 'productInfoFileExists': True,
+    # 'ciqInfoFileExists': True,
+    # 'upcoming': False,
+    # 'productInfoHash': 'c79e0b7fee6d01b0d47757cf7ad587e5',
+    # 'ciqInfoHash': 'c96d495c2b8512a4e3c0c504d6f936a2',
+    # 'group': 'Watches/Wearables',
+    # 'displayName': 'Descent™ Mk1',
+    # 'lastUpdateTime': '2020-08-19 17:16:16'}
+    devices = get_device_list(token)
+    index = _read_sync_index()
+    if names is not None:
+        unknown = set(names) - set(d['name'] for d in devices)
+        if unknown:
+            logger.warning("Unknown device(s): %s." % ", ".join(
+                sorted(unknown)))
+        devices = [d for d in devices if d['name'] in names]
+    added, changed, removed = _device_delta(index, devices, devices_root)
+    if names is not None:
+        removed = []
+    for name in removed:
+        logger.info("- device %s" % name)
+    for device in changed:
+        logger.info("~ device %s" % device['name'])
+    for device in added:
+        logger.info("+ device %s" % device['name'])
+    if dry_run:
+        return []
+    for name in removed:
+        if os.path.exists(os.path.join(devices_root, name)):
+            shutil.rmtree(os.path.join(devices_root, name))
+        del index[name]
+    if removed:
+        _write_sync_index(index)
+
+    def done(device):
+        index[device['name']] = _sync_entry(device)
+        _write_sync_index(index)
+
+    return _install_all('device', added + changed, _install_device, token,
+                        devices_root, done=done)
+
+
+def _list_devices(args):
+    devices = device_catalog.query(args.group, args.name, args.part_number,
+                                   args.updated_since)
+    if args.installed is not None:
+        devices_root = get_devices_root()
+        devices = [d for d in devices if args.installed == os.path.isdir(
+            os.path.join(devices_root, d['name']))]
+    if args.json:
+        print(json.dumps(devices, indent=1))
+        return
+    for device in devices:
         # {'deviceUuid': 'b957e0db-67bb-4b6f-9aa2-426efcbe46fe',
         # 'partNumber': '006-B2859-00',
         # 'name': 'descentmk1',
@@ -0,0 +1,244 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import sys
+import json
+import math
+import time
+import argparse
+from ciqw.config import read_config, CONFIG_DIR
+
+logger = logging.getLogger(__name__)
+
+# One JSON line per build, run, simulator start and install, with the
+# SDK version, so that 'ciqw-stats' can compare them over time:
+# {"t": 1634567890.1, "kind": "build", "sdk": "4.0.6",
+#  "device": "fenix6", "seconds": 2.31, "cache": "miss", "ok": true}
+METRICS_FILENAME = os.path.join(CONFIG_DIR, 'metrics.jsonl')
+# Past that size, the older half is dropped.
+MAX_SIZE = 4 * 1024 * 1024
+REGRESSION_THRESHOLD = 20
+
+
+def record(kind, **fields):
+    # A single append of a short line, safe from several threads or
+    # processes; metrics never make a command fail.
+    try:
+        data = {'t': round(time.time(), 3), 'kind': kind,
+                'sdk': read_config().get('version')}
+        data.update(fields)
+        line = json.dumps(data) + '\n'
+        os.makedirs(CONFIG_DIR, exist_ok=True)
+        fd = os.open(METRICS_FILENAME,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size > MAX_SIZE:
+            _trim()
+    except Exception as e:
+        logger.debug("Unable to record metrics: %s" % e)
+
+
+def _trim():
+    lines = open(METRICS_FILENAME).readlines()
+    tmp = "%s.%d.tmp" % (METRICS_FILENAME, os.getpid())
+    with open(tmp, 'w') as f:
+        f.writelines(lines[len(lines) // 2:])
+    os.replace(tmp, METRICS_FILENAME)
+
+
+def read(since=0):
+    records = []
+    if os.path.exists(METRICS_FILENAME):
+        for line in open(METRICS_FILENAME):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('t', 0) >= since:
+                records.append(record)
+    return records
+
+
+def percentile(values, p):
+    # Nearest rank.
+    values = sorted(values)
+    return values[max(int(math.ceil(p / 100. * len(values))) - 1, 0)]
+
+
+def _groups(records, kind, key, value, where=lambda r: True):
+    groups = {}
+    for r in records:
+        if r.get('kind') == kind and where(r) and r.get(value) is not None:
+            groups.setdefault(key(r), []).append(r[value])
+    return groups
+
+
+def _compiled(r):
+    return r.get('ok') and r.get('cache') != 'hit'
+
+
+def _sdk(r):
+    return (('sdk', r.get('sdk') or ''),)
+
+
+def _sdk_device(r):
+    return _sdk(r) + (('device', r.get('device') or ''),)
+
+
+def _series(records):
+    # (metric name, description, unit, {labels: [values]}), the labels
+    # being ((name, value), ...).
+    return [
+        ('ciqw_build_seconds', "Successful builds not restored from the "
+         "build cache.", 'seconds',
+         _groups(records, 'build', _sdk_device, 'seconds', _compiled)),
+        ('ciqw_run_seconds', "ciqw-run, from start to monkeydo.",
+         'seconds', _groups(records, 'run', _sdk_device, 'seconds')),
+        ('ciqw_simulator_start_seconds', "Simulator boots.", 'seconds',
+         _groups(records, 'simulator', _sdk, 'seconds')),
+        ('ciqw_install_bytes_per_second', "Install download throughput.",
+         'bytes_per_second', _groups(
+             [dict(r, rate=r['bytes'] / max(r['seconds'], 0.001))
+              for r in records if r.get('kind') == 'install'
+              and r.get('bytes')],
+             'install', lambda r: (('what', r['what']),), 'rate')),
+    ]
+
+
+def _cache_hits(records):
+    # {(sdk, device): (hits, builds)}
+    hits = {}
+    for r in records:
+        if r.get('kind') == 'build' and r.get('cache') in ('hit', 'miss'):
+            key = (r.get('sdk') or '', r.get('device') or '')
+            h, n = hits.get(key, (0, 0))
+            hits[key] = (h + (r['cache'] == 'hit'), n + 1)
+    return hits
+
+
+def regressions(records, threshold=REGRESSION_THRESHOLD):
+    # Per device, the median build time of each SDK against the SDK
+    # used before it.
+    found = []
+    builds = [r for r in records if r.get('kind') == 'build' and
+              r.get('ok') and r.get('cache') != 'hit']
+    for device in sorted(set(r.get('device') for r in builds)):
+        sdks = []
+        for r in sorted(builds, key=lambda r: r['t']):
+            if r.get('device') == device and r.get('sdk') not in sdks:
+                sdks.append(r.get('sdk'))
+        for before, after in zip(sdks, sdks[1:]):
+            p50 = [percentile([r['seconds'] for r in builds
+                               if r.get('device') == device and
+                               r.get('sdk') == sdk], 50)
+                   for sdk in (before, after)]
+            change = (p50[1] - p50[0]) * 100. / max(p50[0], 0.001)
+            if change >= threshold:
+                found.append((device, before, after, p50[0], p50[1],
+                              change))
+    return found
+
+
+def _labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace(
+        '\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+def openmetrics(records):
+    lines = []
+    for name, description, unit, groups in _series(records):
+        lines.append("# TYPE %s summary" % name)
+        lines.append("# UNIT %s %s" % (name, unit))
+        lines.append("# HELP %s %s" % (name, description))
+        for labels, values in sorted(groups.items()):
+            for q in (0.5, 0.9, 0.99):
+                lines.append("%s%s %g" % (name, _labels(labels, quantile=q),
+                                          percentile(values, q * 100)))
+            lines.append("%s_count%s %d" % (name, _labels(labels),
+                                            len(values)))
+            lines.append("%s_sum%s %g" % (name, _labels(labels),
+                                          sum(values)))
+    for name, description, index in (
+            ('ciqw_build_cache_hits', "Builds restored from a cache.", 0),
+            ('ciqw_build_cache_lookups', "Builds looked up in a cache.", 1)):
+        lines.append("# TYPE %s counter" % name)
+        lines.append("# HELP %s %s" % (name, description))
+        for (sdk, device), counts in sorted(_cache_hits(records).items()):
+            lines.append("%s_total%s %d" % (name, _labels(
+                (('sdk', sdk), ('device', device))), counts[index]))
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def _report(records, threshold):
+    for name, _description, unit, groups in _series(records):
+        if not groups:
+            continue
+        print("%s (%s)" % (name, unit))
+        for labels, values in sorted(groups.items()):
+            print("  %-32s %5d  p50 %9.2f  p90 %9.2f  max %9.2f" % (
+                " ".join(v for _k, v in labels), len(values),
+                percentile(values, 50), percentile(values, 90),
+                max(values)))
+    hits = _cache_hits(records)
+    if hits:
+        print("build cache hit rate")
+        for (sdk, device), (h, n) in sorted(hits.items()):
+            print("  %-32s %5d  %5.1f%%" % ("%s %s" % (sdk, device), n,
+                                            h * 100. / n))
+    for device, before, after, p50_before, p50_after, change in \
+            regressions(records, threshold):
+        logger.warning("%s builds %.0f%% slower with SDK %s than %s "
+                       "(p50 %.2fs, was %.2fs)." % (
+                           device, change, after, before,
+                           p50_after, p50_before))
+
+
+def stats():
+    parser = argparse.ArgumentParser(
+        prog='ciqw-stats', description="Report build, run, simulator and "
+        "install times recorded by ciqw.")
+    parser.add_argument('--days', type=float,
+                        help="only the last DAYS days")
+    parser.add_argument('--threshold', type=float,
+                        default=REGRESSION_THRESHOLD,
+                        help="slowdown in %% reported as a regression "
+                        "(default: %d)" % REGRESSION_THRESHOLD)
+    parser.add_argument('--openmetrics', metavar='FILE', nargs='?',
+                        const='-', help="export OpenMetrics text to FILE "
+                        "(e.g. for the node exporter textfile collector) "
+                        "or stdout")
+    args = parser.parse_args()
+    records = read(time.time() - args.days * 86400 if args.days else 0)
+    if args.openmetrics == '-':
+        sys.stdout.write(openmetrics(records))
+    elif args.openmetrics:
+        tmp = "%s.%d.tmp" % (args.openmetrics, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(openmetrics(records))
+        os.replace(tmp, args.openmetrics)
+    elif not records:
+        logger.info("No metrics recorded yet.")
+    else:
+        _report(records, args.threshold)
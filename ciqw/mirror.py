@@ -0,0 +1,133 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import sys
+import argparse
+from ciqw.auth import _get_access_token
+from ciqw.config import read_json, write_json
+from ciqw.net import DEVCIQ, APIGCS, session, download
+from ciqw.sdks import agreement, platform_package
+
+logger = logging.getLogger(__name__)
+
+# The mirror mimics the upstream URL layout under 'devciq/' and
+# 'apigcs/', see ciqw.net.endpoint, so it can be used through file://
+# or served as is by any static HTTP server.
+
+
+def _fetch(url, filename, headers=None):
+    if os.path.exists(filename):
+        return
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    logger.info("Mirroring '%s'." % url)
+    download(url, filename, headers)
+
+
+def _mirror_sdks(root, versions, platforms):
+    req = session().get(DEVCIQ + 'sdks/sdks.json')
+    req.raise_for_status()
+    catalog = req.json()
+    if not versions:
+        versions = [[sdk['version'] for sdk in catalog
+                     if 'preview' not in sdk['version'] and
+                     sdk.get(platform_package())][-1]]
+    known = [sdk['version'] for sdk in catalog]
+    for version in versions:
+        if version not in known:
+            raise Exception("Version '%s' is not available." % version)
+    for sdk in catalog:
+        if sdk['version'] not in versions:
+            continue
+        for platform in platforms:
+            if sdk.get(platform):
+                _fetch(DEVCIQ + 'sdks/' + sdk[platform],
+                       os.path.join(root, 'devciq', 'sdks', sdk[platform]))
+    write_json(os.path.join(root, 'devciq', 'sdks', 'sdks.json'), catalog)
+
+
+def _mirror_sdkmanager(root, platforms):
+    req = session().get(DEVCIQ + 'sdk-manager/sdk-manager.json')
+    req.raise_for_status()
+    sdkmanager = req.json()
+    for platform in platforms:
+        if sdkmanager.get(platform):
+            _fetch(DEVCIQ + 'sdk-manager/' + sdkmanager[platform],
+                   os.path.join(root, 'devciq', 'sdk-manager',
+                                sdkmanager[platform]))
+    write_json(os.path.join(root, 'devciq', 'sdk-manager',
+                             'sdk-manager.json'), sdkmanager)
+
+
+def _mirror_items(root, token, kind, hash_key, upstream_path, mirror_path):
+    base = os.path.join(root, 'apigcs', 'ciq-product-onboarding')
+    headers = {'accept': 'application/json',
+               'authorization': 'Bearer %s' % token}
+    req = session().get(APIGCS + '/ciq-product-onboarding/%s' % kind,
+                        headers=headers)
+    req.raise_for_status()
+    items = req.json()
+    previous = dict((i['name'], i.get(hash_key)) for i in read_json(
+        os.path.join(base, '%s.json' % kind), []))
+    headers['accept'] = '*/*'
+    for item in items:
+        filename = os.path.join(base, *mirror_path(item).split('/'))
+        if previous.get(item['name']) != item.get(hash_key) and \
+                os.path.exists(filename):
+            os.unlink(filename)
+        _fetch(APIGCS + '/ciq-product-onboarding/' + upstream_path(item),
+               filename, headers)
+    write_json(os.path.join(base, '%s.json' % kind), items)
+
+
+def mirror():
+    parser = argparse.ArgumentParser(
+        prog='ciqw-mirror',
+        description="Snapshot Connect IQ downloads into a local mirror.")
+    parser.add_argument('directory')
+    parser.add_argument('versions', nargs='*',
+                        help="SDK versions (default: last stable)")
+    parser.add_argument('--platform', action='append',
+                        choices=['linux', 'mac', 'windows'],
+                        help="SDK platforms (default: this one)")
+    parser.add_argument('--skip-fonts-and-devices', action='store_true')
+    args = parser.parse_args()
+    root = os.path.abspath(args.directory)
+    try:
+        platforms = args.platform or [platform_package()]
+        agreement()
+        _mirror_sdks(root, args.versions, platforms)
+        _mirror_sdkmanager(root, platforms)
+        if not args.skip_fonts_and_devices:
+            token = _get_access_token()
+            if not token:
+                logger.warning("Not logged in, skipping fonts and devices.")
+            else:
+                _mirror_items(
+                    root, token, 'fonts', 'fontHash',
+                    lambda f: 'fonts/font?fontName=%s' % f['name'],
+                    lambda f: 'fonts/font/%s' % f['name'])
+                _mirror_items(
+                    root, token, 'devices', 'ciqInfoHash',
+                    lambda d: 'devices/%s/ciqInfo' % d['partNumber'],
+                    lambda d: 'devices/%s/ciqInfo' % d['partNumber'])
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+    logger.info("Mirror ready in '%s', set 'mirror = %s' in the ciqw "
+                "configuration to use it." % (root, root))
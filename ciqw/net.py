@@ -0,0 +1,248 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import email.utils
+import urllib.parse
+from ciqw import trace
+from ciqw.config import read_config
+from ciqw.extract import extract
+
+logger = logging.getLogger(__name__)
+
+DEVCIQ = 'https://developer.garmin.com/downloads/connect-iq/'
+APIGCS = "https://api.gcs.garmin.com"
+SSL_VERIFY = not sys.platform.lower().startswith('darwin')
+CHUNK_SIZE = 1024 * 1024
+# Archives smaller than that are extracted from memory, bigger ones
+# are spooled to a temporary file.
+SPOOL_SIZE = 16 * 1024 * 1024
+MAX_ARCHIVE_SIZE = 512 * 1024 * 1024
+PROGRESS_INTERVAL = 5
+
+
+def _human(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return "%.1f %s" % (size, unit)
+        size /= 1024.
+
+
+class FileAdapter:
+    # Serves file:// URLs so a mirror on local disk behaves like the
+    # remote endpoints, Range requests included.
+
+    def send(self, request, **kwargs):
+        import requests
+        import urllib.request
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        path = urllib.request.url2pathname(
+            urllib.parse.urlparse(request.url).path)
+        # Error responses get an empty body, to be read or closed.
+        response.raw = io.BytesIO(b'')
+        if not os.path.isfile(path):
+            response.status_code = 404
+            response.reason = 'Not Found'
+            return response
+        st = os.stat(path)
+        f = open(path, 'rb')
+        offset = 0
+        ranges = request.headers.get('Range', '')
+        if ranges.startswith('bytes=') and ranges.endswith('-'):
+            offset = int(ranges[6:-1])
+            if offset >= st.st_size:
+                f.close()
+                response.status_code = 416
+                response.reason = 'Range Not Satisfiable'
+                return response
+            f.seek(offset)
+            response.status_code = 206
+            response.reason = 'Partial Content'
+        else:
+            response.status_code = 200
+            response.reason = 'OK'
+        response.headers['Content-Length'] = str(st.st_size - offset)
+        response.headers['Last-Modified'] = email.utils.formatdate(
+            st.st_mtime, usegmt=True)
+        response.raw = f
+        return response
+
+    def close(self):
+        pass
+
+
+_session = None
+
+
+def session():
+    # Shared by every download so connections are kept alive, the pool
+    # is sized for the configured number of concurrent downloads.
+    global _session
+    if _session is None:
+        # Imported here, most commands never reach the network.
+        import requests
+        import requests.adapters
+        size = max(int(read_config().get('concurrency') or 1), 10)
+        _session = requests.Session()
+        _session.verify = SSL_VERIFY
+        for prefix in ('http://', 'https://'):
+            _session.mount(prefix, requests.adapters.HTTPAdapter(
+                pool_connections=size, pool_maxsize=size))
+        _session.mount('file://', FileAdapter())
+    return _session
+
+
+def retry(count, fct, *args):
+    for attempt in range(count):
+        try:
+            return fct(*args)
+        except Exception as e:
+            if attempt + 1 >= count:
+                raise
+            delay = 2 ** attempt
+            logger.warning("%s, retrying in %ds." % (e, delay))
+            time.sleep(delay)
+
+
+def get_mirror():
+    mirror = read_config().get('mirror', '').strip()
+    if mirror and '://' not in mirror:
+        import urllib.request
+        mirror = 'file://' + urllib.request.pathname2url(
+            os.path.abspath(os.path.expanduser(mirror)))
+    return mirror.rstrip('/')
+
+
+def endpoint(service, path, mirror_path=None):
+    # 'mirror_path' is where the resource lives in a mirror when it
+    # can not be stored under its upstream path (list endpoints and
+    # query strings).
+    mirror = get_mirror()
+    if mirror:
+        return "%s/%s/%s" % (mirror, service,
+                             (mirror_path or path).lstrip('/'))
+    return {'devciq': DEVCIQ, 'apigcs': APIGCS + '/'}[service] + \
+        path.lstrip('/')
+
+
+def download(url, filename, headers=None):
+    # Stream 'url' into 'filename' through a '.part' file, resuming
+    # a previous interrupted transfer when the server supports ranges.
+    # Returns the number of bytes fetched.
+    part = filename + '.part'
+    headers = dict(headers or {})
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+    req = session().get(url, headers=headers, stream=True)
+    if req.status_code == 416:
+        # Nothing left to fetch, the part file is complete.
+        req.close()
+        os.replace(part, filename)
+        return 0
+    req.raise_for_status()
+    if offset and req.status_code != 206:
+        logger.info("Server does not support resume, restarting '%s'." %
+                    url)
+        offset = 0
+    elif offset:
+        logger.info("Resuming '%s' at %s." % (url, _human(offset)))
+    total = req.headers.get('Content-Length')
+    total = int(total) + offset if total else None
+    done = offset
+    start = last = time.time()
+    with req, open(part, 'ab' if offset else 'wb') as f, \
+            trace.span('download', url=url) as span:
+        for chunk in req.iter_content(CHUNK_SIZE):
+            f.write(chunk)
+            done += len(chunk)
+            now = time.time()
+            if now - last >= PROGRESS_INTERVAL:
+                last = now
+                rate = (done - offset) / (now - start)
+                if total:
+                    logger.info("%s / %s (%d%%) at %s/s" % (
+                        _human(done), _human(total), done * 100 // total,
+                        _human(rate)))
+                else:
+                    logger.info("%s at %s/s" % (_human(done), _human(rate)))
+        span['bytes'] = done - offset
+    if total and done != total:
+        raise Exception("Incomplete download of '%s' (%s of %s)." % (
+            url, _human(done), _human(total)))
+    os.replace(part, filename)
+    elapsed = max(time.time() - start, 0.001)
+    logger.info("Downloaded %s in %.1fs (%s/s)." % (
+        _human(done - offset), elapsed, _human((done - offset) / elapsed)))
+    return done - offset
+
+
+def download_and_extract(url, target, headers=None, merge=False):
+    # The archive is extracted next to 'target' then renamed over it,
+    # or with 'merge', its files are moved one by one into 'target', so
+    # an interruption never leaves a partially populated directory.
+    req = session().get(url, headers=headers, stream=True)
+    req.raise_for_status()
+    with req, tempfile.SpooledTemporaryFile(SPOOL_SIZE) as buffer:
+        size = 0
+        with trace.span('download', url=url) as span:
+            for chunk in req.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_ARCHIVE_SIZE:
+                    raise Exception("'%s' is bigger than %s." % (
+                        url, _human(MAX_ARCHIVE_SIZE)))
+                buffer.write(chunk)
+            span['bytes'] = size
+        buffer.seek(0)
+        parent = os.path.dirname(os.path.abspath(target))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(
+            dir=parent, prefix='.%s.' % os.path.basename(target))
+        try:
+            with trace.span('extract', target=target):
+                extract(buffer, tmp, processes=1)
+            if merge:
+                os.makedirs(target, exist_ok=True)
+                for root, _dirs, files in os.walk(tmp):
+                    dest = os.path.join(target, os.path.relpath(root, tmp))
+                    os.makedirs(dest, exist_ok=True)
+                    for f in files:
+                        os.replace(os.path.join(root, f),
+                                   os.path.join(dest, f))
+            else:
+                old = None
+                if os.path.exists(target):
+                    old = tempfile.mkdtemp(
+                        dir=parent,
+                        prefix='.%s.old.' % os.path.basename(target))
+                    os.rmdir(old)
+                    os.rename(target, old)
+                os.rename(tmp, target)
+                if old:
+                    shutil.rmtree(old)
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+    return size
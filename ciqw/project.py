@@ -0,0 +1,258 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import json
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+NS = 'http://www.garmin.com/xml/connectiq'
+
+
+def get_jungles(path='.'):
+    return sorted(f for f in os.listdir(path) if f.endswith('.jungle'))
+
+
+def get_manifest_filename(path='.'):
+    # A jungle may point to another manifest with 'project.manifest'.
+    manifest = 'manifest.xml'
+    for jungle in get_jungles(path):
+        for line in open(os.path.join(path, jungle)):
+            key, sep, value = line.split('#')[0].partition('=')
+            if sep and key.strip() == 'project.manifest':
+                manifest = value.strip()
+    return os.path.join(path, manifest)
+
+
+def get_entry(path='.'):
+    manifest = ET.parse(get_manifest_filename(path))
+    return manifest.find('{%s}application' % NS).attrib['entry']
+
+
+def get_products(path='.'):
+    manifest = ET.parse(get_manifest_filename(path))
+    return [p.attrib['id'] for p in manifest.iter('{%s}product' % NS)]
+
+
+# What a device build reads, from the jungles: 'key = value' lines
+# where values are ';' separated lists that may refer to other keys
+# with '$(key)', and keys are qualified by 'base', a device, a device
+# family such as 'round-240x240', or a language ('base.lang.fre').
+# Resource directories also get qualified siblings picked up by the
+# compiler: 'resources-fenix6', 'resources-round-240x240',
+# 'resources-fre'.
+
+PATH_KINDS = ('sourcePath', 'resourcePath', 'barrelPath')
+DEFAULT_PATHS = {'sourcePath': 'source', 'resourcePath': 'resources',
+                 'barrelPath': ''}
+_REF = re.compile(r'\$\(([^)]*)\)')
+_RESOLUTION = re.compile(r'^\d+x\d+$')
+_models = {}
+
+
+def parse_jungles(filenames):
+    # Values are expanded as they are assigned, so that
+    # 'base.sourcePath = $(base.sourcePath);extra' appends.
+    keys = {'base.%s' % k: v for k, v in DEFAULT_PATHS.items()}
+    for filename in filenames:
+        for line in open(filename):
+            key, sep, value = line.split('#')[0].partition('=')
+            if not sep or not key.strip():
+                continue
+            keys[key.strip()] = _REF.sub(
+                lambda m: keys.get(m.group(1).strip(), ''), value.strip())
+    return keys
+
+
+def _split(value):
+    return [os.path.normpath(v.strip()) for v in value.split(';')
+            if v.strip()]
+
+
+def _device_qualifiers(device):
+    # From the installed device, as 'round', '240x240'; nothing when
+    # it is not installed, then family qualified paths are kept.
+    from ciqw.fonts_and_devices import get_devices_root
+    try:
+        info = json.load(open(os.path.join(
+            get_devices_root(), device, 'compiler.json')))
+    except (OSError, ValueError):
+        return set()
+    qualifiers = set(filter(None, (info.get('deviceFamily') or
+                                   '').split('-')))
+    if info.get('displayType'):
+        qualifiers.add(info['displayType'])
+    resolution = info.get('resolution') or {}
+    if resolution.get('width') and resolution.get('height'):
+        qualifiers.add("%dx%d" % (resolution['width'],
+                                  resolution['height']))
+    return qualifiers
+
+
+class Project:
+
+    def __init__(self, path='.'):
+        self.path = path
+        self.manifest = get_manifest_filename(path)
+        self.jungles = [os.path.join(path, j) for j in get_jungles(path)]
+        self.keys = parse_jungles(self.jungles)
+        self.products = get_products(path)
+        self._qualifiers = {}
+        self._roots = {}
+        # Whatever makes the model outdated when it changes; the
+        # project directory for new qualified resource directories.
+        self.stamps = {f: None for f in [self.manifest, path] + self.jungles}
+        for kind in PATH_KINDS:
+            for key, value in self.keys.items():
+                if key.endswith('.' + kind) or kind == 'resourcePath' and \
+                   '.lang.' in key:
+                    for p in _split(value):
+                        self.stamps[os.path.dirname(
+                            os.path.join(path, p)) or path] = None
+        for f in self.stamps:
+            self.stamps[f] = _mtime(f)
+
+    def qualifiers(self, device):
+        if device not in self._qualifiers:
+            self._qualifiers[device] = _device_qualifiers(device)
+        return self._qualifiers[device]
+
+    def _applies(self, qualifier, device):
+        # Qualifiers naming another device, the family or the
+        # resolution of another device, do not apply; anything else
+        # (languages) does.
+        # An uninstalled device only rules out other device names.
+        own = self.qualifiers(device) | {device}
+        others = set(self.products)
+        if self.qualifiers(device):
+            for product in self.products:
+                others |= self.qualifiers(product)
+        if any(_RESOLUTION.match(q) for q in own):
+            others |= {q for q in qualifier.split('-')
+                       if _RESOLUTION.match(q)}
+        return all(q in own or q not in others
+                   for q in qualifier.split('-'))
+
+    def _value(self, device, kind):
+        for qualifier in [device] + sorted(self.qualifiers(device)) + \
+                ['base']:
+            key = '%s.%s' % (qualifier, kind)
+            if key in self.keys:
+                return self.keys[key]
+        return ''
+
+    def roots(self, device):
+        # {kind: [paths]} for one device, relative to the project.
+        if device in self._roots:
+            return self._roots[device]
+        roots = {kind: _split(self._value(device, kind))
+                 for kind in PATH_KINDS}
+        for key, value in sorted(self.keys.items()):
+            qualifier, _, lang = key.partition('.lang.')
+            if lang and qualifier in ('base', device):
+                roots['resourcePath'].extend(_split(value))
+        for resources in list(roots['resourcePath']):
+            parent, name = os.path.split(resources)
+            try:
+                siblings = sorted(os.listdir(os.path.join(self.path,
+                                                          parent)))
+            except OSError:
+                continue
+            for sibling in siblings:
+                if sibling.startswith(name + '-') and \
+                   self._applies(sibling[len(name) + 1:], device):
+                    roots['resourcePath'].append(
+                        os.path.normpath(os.path.join(parent, sibling)))
+        self._roots[device] = roots
+        return roots
+
+    def is_input(self, kind, filename):
+        if filename.startswith('.'):
+            return False
+        if kind == 'sourcePath':
+            return filename.endswith('.mc')
+        if kind == 'barrelPath':
+            return filename.endswith('.barrel')
+        return not filename.endswith(('.debug.xml', '.prg', '.iq'))
+
+    def files(self, device):
+        # The project files a build for 'device' reads, sorted and
+        # relative to the project.
+        files = {os.path.relpath(f, self.path)
+                 for f in [self.manifest] + self.jungles}
+        for kind, paths in self.roots(device).items():
+            for p in paths:
+                top = os.path.join(self.path, p)
+                if os.path.isfile(top):
+                    files.add(p)
+                    continue
+                for root, dirs, filenames in os.walk(top):
+                    dirs[:] = [d for d in dirs if not d.startswith('.')]
+                    files.update(
+                        os.path.relpath(os.path.join(root, f), self.path)
+                        for f in filenames if self.is_input(kind, f))
+        return sorted(files)
+
+    def trees(self, devices):
+        # The directories to watch for 'devices'.
+        trees = set()
+        for device in devices:
+            for paths in self.roots(device).values():
+                trees.update(os.path.join(self.path, p) for p in paths
+                             if os.path.isdir(os.path.join(self.path, p)))
+        return sorted(t for t in trees
+                      if not any(t.startswith(o + os.sep) for o in trees))
+
+    def devices_for(self, filename, devices):
+        # Those of 'devices' whose build reads 'filename', a path
+        # relative to the project.
+        filename = os.path.normpath(filename)
+        directory, name = os.path.split(filename)
+        if not directory and (name.endswith(('.jungle', '.monkey')) or
+                              filename == os.path.relpath(
+                                  self.manifest, self.path)):
+            return list(devices)
+        affected = []
+        for device in devices:
+            for kind, paths in self.roots(device).items():
+                if self.is_input(kind, name) and any(
+                        filename == p or filename.startswith(p + os.sep)
+                        for p in paths):
+                    affected.append(device)
+                    break
+        return affected
+
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load(path='.'):
+    # The model is kept while the manifest, the jungles and the
+    # directories holding the paths they name are unchanged.
+    key = os.path.abspath(path)
+    model = _models.get(key)
+    if model is None or any(_mtime(f) != m
+                            for f, m in model.stamps.items()):
+        model = _models[key] = Project(path)
+    return model
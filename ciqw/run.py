@@ -18,32 +18,47 @@
 import logging
 import os
 import sys
+import time
+import queue
 import socket
+import argparse
+import threading
 import subprocess
-import xml.etree.ElementTree as ET
-have_inotify = False
-try:
-    import inotify.adapters
-    have_inotify = True
-except Exception:
-    pass
-
-from ciqw.sdks import _install_sdk  # pylint: disable=C0413
-from ciqw.config import read_config, genkey  # pylint: disable=C0413
+import concurrent.futures
+from ciqw.config import read_config, _genkey  # pylint: disable=C0413
+from ciqw.fonts_and_devices import ensure_devices, \
+    get_devices_root  # pylint: disable=C0413
+from ciqw import project, build_cache, compiler, \
+    cds, watch, sessions, testing, trace, metrics  # pylint: disable=C0413
 
 logger = logging.getLogger(__name__)
 
 
 def _get_app_from_manifest():
-    manifest = ET.parse('manifest.xml')
-    ns = 'http://www.garmin.com/xml/connectiq'
-    return manifest.find('{%s}application' % ns).attrib['entry']
+    return project.get_entry()
+
+
+_sdk_roots = {}
+
+
+def _find_sdk_root(config):
+    version = config['version']
+    if '.beta' in version:
+        version = version.replace(".beta", "-Beta-")
+    for f in sorted(os.listdir(os.path.join(config['sdks']))):
+        if (os.path.isdir(os.path.join(config['sdks'], f)) and
+                f.startswith("connectiq-sdk-") and
+            version in f):
+            return os.path.join(config['sdks'], f)
 
 
 def get_sdk_root(name, config):
+    # Resolved once per process and version; the SDK catalog is only
+    # looked at when the configured SDK is not installed.
+    from ciqw.sdks import _install_sdk
     if not config.get('version'):
         _install_sdk()
-    config.update(read_config())
+        config.update(read_config())
     if sys.platform.lower().startswith('darwin'):
         if name == 'simulator':
             return os.path.join(os.getenv('HOME'), 'Library',
@@ -55,74 +70,313 @@ def get_sdk_root(name, config):
                             'Application Support',
                             'Garmin', 'ConnectIQ', 'Sdks',
                             'connectiq-sdk', 'bin', name)
-    sdk = None
-    version = config['version']
-    if '.beta' in version:
-        version = version.replace(".beta", "-Beta-")
-    for f in os.listdir(os.path.join(config['sdks'])):
-        if (os.path.isdir(os.path.join(config['sdks'], f)) and
-                f.startswith("connectiq-sdk-") and
-            version in f):
-            sdk = f
-            break
-    if sdk:
-        return os.path.join(config['sdks'], sdk)
-    _install_sdk(config.get('version'))
+    key = (config['sdks'], config['version'])
+    if key in _sdk_roots and os.path.isdir(_sdk_roots[key]):
+        return _sdk_roots[key]
+    with trace.span('get_sdk_root', version=config['version']):
+        sdk = _find_sdk_root(config)
+        if not sdk:
+            _install_sdk(config['version'])
+            sdk = _find_sdk_root(config)
+    if not sdk:
+        raise Exception("SDK '%s' is not installed." % config['version'])
+    _sdk_roots[key] = sdk
+    return sdk
 
 
 def _get_sdk_bin(name, config):
     return os.path.join(get_sdk_root(name, config), 'bin', name)
 
 
-def sim():
-    s = socket.socket(socket. AF_INET, socket. SOCK_STREAM)
+SIM_PORT = 42877
+
+
+def _sim_listening():
     try:
-        s.connect(("127.0.0.1", 42877))
-        s.close()
-        logger.info("Simulator already runnning.")
-        return
-    except:
-        pass
+        socket.create_connection(("127.0.0.1", SIM_PORT), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+
+class Simulator:
+    # What _sim() returns right after starting the simulator, so that
+    # something else (a build) can be done while it boots; wait()
+    # returns once it accepts connections.
+
+    def __init__(self, process=None, timeout=60):
+        self.process = process
+        self.timeout = timeout
+        self.started = time.time()
+
+    def wait(self):
+        deadline = time.time() + self.timeout
+        delay = 0.05
+        with trace.span('simulator wait', started=bool(self.process)):
+            while not _sim_listening():
+                if self.process is not None and \
+                   self.process.poll() is not None:
+                    raise Exception("Simulator exited with code %d." %
+                                    self.process.returncode)
+                if time.time() >= deadline:
+                    raise Exception("Simulator not listening on port %d "
+                                    "after %ss." % (SIM_PORT, self.timeout))
+                time.sleep(min(delay, max(deadline - time.time(), 0)))
+                delay = min(delay * 2, 1)
+        if self.process is not None:
+            metrics.record('simulator', seconds=round(
+                time.time() - self.started, 3))
+            self.process = None
+        return self
+
+
+def _sim(previous=None):
+    # A simulator 'previous' started and that is still booting is
+    # waited for again rather than started twice.
+    if previous is not None and previous.process is not None and \
+       previous.process.poll() is None:
+        return previous
     config = read_config()
+    timeout = float(config.get('sim_timeout') or 60)
+    if _sim_listening():
+        logger.info("Simulator already runnning.")
+        return Simulator(timeout=timeout)
     command = _get_sdk_bin('simulator', config)
     logger.info("Calling '%s'." % command)
-    subprocess.Popen([command])
+    return Simulator(subprocess.Popen([command]), timeout)
+
+
+def sim():
+    try:
+        _sim().wait()
+    except Exception as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+
+def _build(do_release=False, device=None, out=None, log=None, cancel=None,
+           test=False):
+    # Setting the 'cancel' event stops a running monkeyc, 'test' builds
+    # the (:test) annotated code for 'ciqw-test'.
+    device = device or read_config()['device']
+    info = {'cache': 'off'}
+    start = time.time()
+    ok = False
+    try:
+        ok = _do_build(do_release, device, out, log, cancel, test, info)
+        return ok
+    finally:
+        metrics.record('release' if do_release else
+                       'test-build' if test else 'build',
+                       device=None if do_release else device,
+                       seconds=round(time.time() - start, 3),
+                       ok=bool(ok), **info)
 
 
-def _build(do_release=False):
+def _do_build(do_release, device, out, log, cancel, test, info):
+    # 'info' gets how the build cache was used, and if the build was
+    # cancelled.
     config = read_config()
-    jungles = set()
-    for f in os.listdir():
-        if f.endswith('.jungle'):
-            jungles.add(f)
+    jungles = project.get_jungles()
     app = _get_app_from_manifest()
     command = [_get_sdk_bin('monkeyc', config)]
     if jungles:
         command.append('--jungles')
         command.extend(jungles)
-    out = "%s.%s" % (app, "prg" if not do_release else "iq")
+    out = out or "%s.%s" % (app, "prg" if not do_release else "iq")
     out_ts = os.stat(out).st_mtime if os.path.exists(out) else 0
     if not do_release:
-        command.extend(['--device', config['device']])
+        command.extend(['--device', device])
     else:
         command.extend(['--release', '--package-app'])
     command.extend(['--output', out])
     command.extend(['--private-key', config['key']])
     if not os.path.exists(config['key']):
-        genkey()
+        _genkey(config['key'])
     command.extend(config.get('flags', '').split())
-    logger.info("Calling '%s'." % " ".join(command))
-    p = subprocess.Popen(command)
-    p.wait()
-    # might check p.returncode ?
+    if test:
+        command.append('--unit-test')
+    digest = None
+    if build_cache.enabled(config):
+        args = [os.path.basename(a) if a in (out, config['key']) else a
+                for a in command[1:]]
+        sdk = os.path.basename(os.path.dirname(os.path.dirname(command[0])))
+        files = build_cache.get_input_files(
+            device=None if do_release else device)
+        with trace.span('build cache', device=device) as span:
+            digest = build_cache.digest(config, files, args,
+                                        config['key'], sdk)
+            changed = build_cache.restore(config, digest, out)
+            span['hit'] = changed is not None
+        info['cache'] = 'miss' if changed is None else 'hit'
+        if changed is not None:
+            logger.info("Restored '%s' from the build cache." %
+                        os.path.abspath(out))
+            return changed
+    # Only now: a build found in a cache needs no device definition.
+    ensure_devices(project.get_products() if do_release else [device])
+    code = None
+    if log is None and cancel is None:
+        # Parallel builds do not go through the single compile server,
+        # nor cancellable ones: it compiles one request at a time and
+        # a compile in progress cannot be stopped.
+        with trace.span('compile server', device=device) as span:
+            code = span['exit'] = compiler.submit(
+                os.path.dirname(os.path.dirname(command[0])), command[1:])
+    if code is None:
+        logger.info("Calling '%s'." % " ".join(command))
+        with trace.span('monkeyc', device=device) as span:
+            # In its own process group, so that cancelling stops the
+            # JVM the monkeyc script starts too, and not only the script.
+            p = subprocess.Popen(command, stdout=log,
+                                 stderr=subprocess.STDOUT if log else None,
+                                 env=cds.java_env(os.path.dirname(
+                                     os.path.dirname(command[0]))),
+                                 start_new_session=True)
+            try:
+                while code is None:
+                    try:
+                        code = span['exit'] = p.wait(0.1)
+                    except subprocess.TimeoutExpired:
+                        if cancel is not None and cancel.is_set():
+                            logger.info("Cancelling build.")
+                            sessions.terminate(p.pid, p)
+                            span['exit'] = p.returncode
+                            info['cancelled'] = True
+                            return False
+            except KeyboardInterrupt:
+                sessions.terminate(p.pid, p)
+                raise
+    if code:
+        return False
     if os.path.exists(out) and os.stat(out).st_mtime > out_ts:
         logger.info("Generated '%s'." % os.path.abspath(out))
+        if digest:
+            build_cache.save(config, digest, out)
         return True
     return False
 
 
+def _get_devices(spec):
+    if spec == 'manifest':
+        return project.get_products()
+    if spec == 'all':
+        root = get_devices_root()
+        return sorted(d for d in os.listdir(root)
+                      if os.path.isdir(os.path.join(root, d)))
+    return [d.strip() for d in spec.split(',') if d.strip()]
+
+
+def _build_one(device, test=False):
+    out = os.path.join('bin', device, "%s%s.prg" % (
+        _get_app_from_manifest(), '-test' if test else ''))
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    if os.path.exists(out):
+        os.unlink(out)
+    start = time.time()
+    with open(os.path.join('bin', device, 'test-build.log' if test else
+                           'build.log'), 'w') as log:
+        ok = _build(device=device, out=out, log=log, test=test)
+    return ok, time.time() - start
+
+
+def _build_matrix(spec, test=False):
+    # Each monkeyc runs in its own JVM, so threads are enough to keep
+    # one compilation per core busy.
+    devices = _get_devices(spec)
+    if not devices:
+        raise Exception("No device to build for.")
+    config = read_config()
+    _get_sdk_bin('monkeyc', config)
+    if not os.path.exists(config['key']):
+        _genkey(config['key'])
+    results = {}
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+        futures = dict((pool.submit(_build_one, d, test), d)
+                       for d in devices)
+        for future in concurrent.futures.as_completed(futures):
+            device = futures[future]
+            try:
+                results[device] = future.result()
+            except Exception as e:
+                logger.error("%s: %s" % (device, e))
+                results[device] = (False, 0)
+    failed = [d for d in devices if not results[d][0]]
+    for device in devices:
+        ok, elapsed = results[device]
+        print('%24s %4s %7.1fs' % (device, 'ok' if ok else 'FAIL', elapsed))
+    for device in failed:
+        logger.error("Build failed for '%s', see '%s'." % (
+            device, os.path.join('bin', device, 'test-build.log' if test
+                                 else 'build.log')))
+    logger.info("%d/%d devices built in %.1fs." % (
+        len(devices) - len(failed), len(devices), time.time() - start))
+    return failed
+
+
+def _monkeydo_env(monkeydo):
+    os.environ['JAVA_OPTIONS'] = "--add-modules=java.xml.bind"
+    return cds.java_env(os.path.dirname(os.path.dirname(monkeydo)))
+
+
+def _launch(config, out):
+    # Replaces whatever monkeydo this project had running on the
+    # device, see 'ciqw-run --status' and 'ciqw-run --stop'.
+    command = [_get_sdk_bin('monkeydo', config),
+               out, config['device']]
+    with trace.span('monkeydo', device=config['device']):
+        sessions.launch(sessions.key(config['device']), command,
+                        env=_monkeydo_env(command[0]),
+                        app=os.path.abspath(out), device=config['device'])
+
+
+def _test(spec, junit=None, timeout=300):
+    # The test builds run in parallel while the simulator boots, the
+    # tests then run one device after the other on the simulator.
+    simulator = _sim()
+    failed = _build_matrix(spec, test=True)
+    config = read_config()
+    app = _get_app_from_manifest()
+    simulator.wait()
+    suites = []
+    for device in _get_devices(spec):
+        log_filename = os.path.join('bin', device, 'test.log')
+        if device in failed:
+            suites.append((device, [testing.error('build', (
+                "Build failed, see '%s'." %
+                os.path.join('bin', device, 'test-build.log')))]))
+            continue
+        command = [_get_sdk_bin('monkeydo', config),
+                   os.path.join('bin', device, "%s-test.prg" % app),
+                   device, '-t']
+        logger.info("Calling '%s'." % " ".join(command))
+        with open(log_filename, 'w') as log, \
+                trace.span('monkeydo -t', device=device) as span:
+            results = testing.run(command, timeout,
+                                  env=_monkeydo_env(command[0]), log=log)
+            span['tests'] = len(results)
+        suites.append((device, results or [testing.error(
+            'run', "No test ran, see '%s'." % log_filename)]))
+    ok = True
+    for device, results in suites:
+        passed = sum(r['status'] == 'PASS' for r in results)
+        print('%24s %4d/%-4d %7.1fs' % (
+            device, passed, len(results), sum(r['time'] for r in results)))
+        for r in results:
+            if r['status'] != 'PASS':
+                print('%24s %5s %s' % ('', r['status'], r['name']))
+        ok = ok and passed == len(results)
+    if junit:
+        testing.write_junit(junit, suites)
+        logger.info("JUnit report written to '%s'." % junit)
+    return ok
+
+
 def _run(force_build=False):
-    sim()
+    # The simulator boots while the app builds.
+    start = time.time()
+    simulator = _sim()
     run = True
     config = read_config()
     app = _get_app_from_manifest()
@@ -130,56 +384,93 @@ def _run(force_build=False):
     if force_build or not os.path.exists(out):
         run = _build()
     if run:
-        os.environ['JAVA_OPTIONS'] = "--add-modules=java.xml.bind"
-        command = [_get_sdk_bin('monkeydo', config),
-                   out, config['device']]
-        logger.info("Calling '%s'." % " ".join(command))
-        p = subprocess.Popen(command)
-        # it kill itself if ran many files
-        # may be one day we will want that
-        # pid_file = os.path.join(os.path.dirname(
-        #     _get_sdk_bin('monkeydo', config)), ".monkeydo.pid")
-        # open(pid_file, "w").write(str(p.pid))
+        simulator.wait()
+        _launch(config, out)
+        metrics.record('run', device=config['device'],
+                       seconds=round(time.time() - start, 3))
+
+
+def _may_build_and_run(paths, cancel, simulator):
+    # Only deploys when the build produced a new output and no change
+    # arrived meanwhile.
+    for path in sorted(paths):
+        logger.info("File modified: '%s'." % path)
+    if _build(cancel=cancel) and not cancel.is_set():
+        simulator.wait()
+        _launch(read_config(), "%s.prg" % _get_app_from_manifest())
+
+
+def _watch_trees(device):
+    return project.load().trees([device])
+
+
+def _is_watched(path, device):
+    # Only what the build for 'device' reads, per the jungles. While
+    # they or the manifest cannot be read (being saved, checked out),
+    # anything is, the build then reports what is wrong.
+    try:
+        return bool(project.load().devices_for(os.path.relpath(path),
+                                               [device]))
+    except Exception:
+        return True
 
 
-def _may_build_and_run(path, filename):
-    logger.info("File modified: '%s'." % os.path.join(path, filename))
-    out = "%s.prg" % _get_app_from_manifest()
-    if not os.path.exists(out):
-        _run(force_build=True)
-    if os.stat(os.path.join(path, filename)).st_mtime > os.stat(out).st_mtime:
-        _run(force_build=True)
+def _watch(changes, cancel, backend, interval):
+    # Whatever stops the watcher is handed to _auto() to end it,
+    # instead of leaving it waiting for changes that never come.
+    try:
+        device = read_config()['device']
+        for path in watch.watch('.', _watch_trees(device), backend,
+                                interval):
+            if _is_watched(path, device):
+                changes.put(path)
+                cancel.set()
+        raise Exception("Watcher stopped.")
+    except Exception as e:
+        changes.put(e)
+        cancel.set()
 
 
 def _auto():
-    if not have_inotify:
-        logger.info("Inotify not supported on your system yet.")
-        sys.error(1)
+    # Changes are gathered until nothing moved for 'auto_delay'
+    # seconds, then built once; a change during a build cancels it
+    # and the loop starts over with everything pending.
+    config = read_config()
+    delay = float(config.get('auto_delay') or 0)
+    simulator = None
+    changes = queue.Queue()
+    cancel = threading.Event()
+    threading.Thread(target=_watch, args=(
+        changes, cancel, config.get('watcher') or 'auto',
+        float(config.get('poll_interval') or 1)), daemon=True).start()
     try:
-        i = inotify.adapters.InotifyTree(".")
-        for _ev, op, path, filename in i.event_gen(yield_nones=False):
-            if 'IN_CLOSE_WRITE' in op:
-                # check if in resources, sources
-                # and for filename (.jungle. .xml)
-                # Rebuild if necessary
-                # check stat of file and prg file
-                if any((
-                        filename == 'manifest.xml',
-                        path == '.' and filename.endswith('.monkey'),
-                        path.startswith('./source') and filename.endswith('.mc'),
-                        path.startswith('./resources') and
-                        filename.endswith('.xml') and
-                        not filename.endswith('.debug.xml'),
-                        path.startswith('./resources') and
-                        filename.endswith('.png'))):
-                    _may_build_and_run(path, filename)
+        while True:
+            paths = set([changes.get()])
+            while True:
+                try:
+                    paths.add(changes.get(timeout=delay))
+                except queue.Empty:
+                    break
+            for e in paths:
+                if isinstance(e, Exception):
+                    raise e
+            cancel.clear()
+            try:
+                simulator = _sim(simulator)
+                _may_build_and_run(paths, cancel, simulator)
+            except Exception as e:
+                logger.error(str(e))
+            if cancel.is_set():
+                logger.info("Sources changed during the build.")
     except KeyboardInterrupt:
         pass
 
-def _cd_call(fct):
+
+def _cd_call(fct, path=None):
     try:
         cwd = None
-        path = sys.argv[1] if len(sys.argv) == 2 else None
+        if path is None:
+            path = sys.argv[1] if len(sys.argv) == 2 else None
         if path:
             cwd = os.path.abspath(os.getcwd())
             os.chdir(path)
@@ -192,16 +483,72 @@ def _cd_call(fct):
 
 
 def build():
-    _cd_call(_build)
+    parser = argparse.ArgumentParser(
+        prog='ciqw-build', description="Build a Connect IQ app.")
+    parser.add_argument('path', nargs='?', default='')
+    parser.add_argument('--devices', metavar='all|manifest|a,b,c',
+                        help="build for several devices in parallel, "
+                        "into bin/<device>/")
+    args = parser.parse_args()
+    if not args.devices:
+        _cd_call(_build, args.path)
+        return
+    failed = []
+    _cd_call(lambda: failed.extend(_build_matrix(args.devices)), args.path)
+    if failed:
+        sys.exit(1)
 
 
 def run():
-    _cd_call(_run)
+    parser = argparse.ArgumentParser(
+        prog='ciqw-run', description="Build if needed and run a Connect "
+        "IQ app in the simulator.")
+    parser.add_argument('path', nargs='?', default='')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--status', action='store_true',
+                       help="list the running monkeydo sessions")
+    group.add_argument('--stop', action='store_true',
+                       help="stop the running monkeydo sessions")
+    args = parser.parse_args()
+    if args.status:
+        for session in sessions.status().values():
+            print("%8d %16s %7ds %s" % (
+                session['pid'], session['device'],
+                time.time() - session['started'], session['app']))
+    elif args.stop:
+        for session in sessions.stop().values():
+            logger.info("Stopped monkeydo %d (%s on %s)." % (
+                session['pid'], os.path.basename(session['app']),
+                session['device']))
+    else:
+        _cd_call(_run, args.path)
 
 
 def auto():
     _cd_call(_auto)
 
 
+def test():
+    parser = argparse.ArgumentParser(
+        prog='ciqw-test', description="Run the (:test) functions of a "
+        "Connect IQ app in the simulator.")
+    parser.add_argument('path', nargs='?', default='')
+    parser.add_argument('--devices', metavar='all|manifest|a,b,c',
+                        help="devices to test on, the configured one by "
+                        "default")
+    parser.add_argument('--junit', metavar='FILE',
+                        help="write a JUnit XML report")
+    parser.add_argument('--timeout', type=float, default=300,
+                        help="seconds allowed per device (default: 300)")
+    args = parser.parse_args()
+    ok = []
+    junit = args.junit and os.path.abspath(args.junit)
+    _cd_call(lambda: ok.append(_test(
+        args.devices or read_config()['device'], junit, args.timeout)),
+        args.path)
+    if not ok[0]:
+        sys.exit(1)
+
+
 def release():
     _build(do_release=True)
@@ -18,18 +18,30 @@
 import logging
 import os
 import sys
-import stat
-import zipfile
 import subprocess
-import configparser
 import shutil
-import requests
-from ciqw.config import read_config, CONFIG_FILENAME
+import time
+import email.utils
+from ciqw.config import read_config, set_config, read_json, write_json, \
+    CONFIG_DIR
+from ciqw.net import session, endpoint, download
+from ciqw.extract import extract
+from ciqw import cds, trace, metrics
 
 logger = logging.getLogger(__name__)
 
-DEVCIQ = 'https://developer.garmin.com/downloads/connect-iq/'
-SSL_VERIFY = not sys.platform.lower().startswith('darwin')
+CATALOG_FILENAME = os.path.join(CONFIG_DIR, 'sdks.json')
+
+
+def platform_package():
+    packages = {'linux': 'linux',
+                'windows': 'windows',
+                'darwin': 'mac'}
+    for _os, _package in packages.items():
+        if sys.platform.lower().startswith(_os):
+            return _package
+    raise Exception("Unable to find package of your OS: '%s'" %
+                    sys.platform)
 
 
 def agreement():
@@ -48,6 +60,9 @@ def _install_sdk(version=None):
     sdks = get_available_sdks()
     if not version:
         version = [v for v in sdks if 'preview' not in v][-1]
+    if version not in sdks:
+        # The cached catalog may predate a new release.
+        sdks = get_available_sdks(refresh=True)
     if version not in sdks:
         raise Exception("Version '%s' is not available." % version)
     config = read_config()
@@ -60,17 +75,19 @@ def _install_sdk(version=None):
     package = os.path.join(config.get('sdks'), package_name)
     agreement()
     if not os.path.exists(package):
-        url = DEVCIQ + 'sdks/' + sdks[version]['package']
+        url = endpoint('devciq', 'sdks/' + sdks[version]['package'])
         logger.info("Downloading '%s'" % url)
         os.makedirs(os.path.dirname(target), exist_ok=True)
-        open(package, "wb").write(
-            requests.get(url, verify=SSL_VERIFY).content)
+        start = time.time()
+        size = download(url, package)
+        metrics.record('install', what='sdk', sdk=version, bytes=size,
+                       seconds=round(time.time() - start, 3))
     if package.endswith(".zip"):
         if not os.path.exists(os.path.join(target, 'bin', 'monkeyc')):
             logger.info("Extracting '%s' to '%s'." % (package, target))
             os.makedirs(target, exist_ok=True)
-            zf = zipfile.ZipFile(package)
-            zf.extractall(target)
+            with trace.span('extract', target=target):
+                extract(package, target, store=config.get('store'))
     if not sys.platform.lower().startswith('darwin'):
         api_db = os.path.join(target, "share", "simulator", "api.db")
         if not os.path.exists(api_db):
@@ -85,33 +102,18 @@ def _install_sdk(version=None):
             subprocess.Popen(["hdiutil", "unmount", VOL]).wait()
     if config.get('version') != version:
         logger.info("Updating version configuration with '%s'." % version)
-        config['version'] = version
-        cp = configparser.ConfigParser()
-        cp['ciqw'] = config
-        with open(CONFIG_FILENAME, 'w') as configfile:
-            cp.write(configfile)
+        set_config('version', version)
         open(os.path.join(config['connectiq'], 'current-sdk.cfg'), "w").write(
             target)
-    if os.path.exists(os.path.join(target, 'bin')):
-        for f in os.listdir(os.path.join(target, 'bin')):
-            bin = os.path.join(target, 'bin', f)
-            os.chmod(bin, os.stat(bin).st_mode | stat.S_IEXEC)
+    if config.get('optimize_sdk', '').lower() in ('1', 'yes', 'true', 'on') \
+            and not os.path.exists(cds._archive(target)):
+        cds.optimize(target)
 
 
 def install_sdkmanager():
-    packages = {'linux': 'linux',
-                'windows': 'windows',
-                'darwin': 'mac'}
-    package = None
-    for _os, _package in packages.items():
-        if sys.platform.lower().startswith(_os):
-            package = _package
-    if not package:
-        raise Exception("Unable to find package of your OS: '%s'" %
-                        sys.platform)
-    sdkmanager = requests.get(
-        DEVCIQ + 'sdk-manager/' + 'sdk-manager.json',
-        verify=SSL_VERIFY).json()
+    package = platform_package()
+    sdkmanager = session().get(
+        endpoint('devciq', 'sdk-manager/' + 'sdk-manager.json')).json()
     archive = sdkmanager[package]
     config = read_config()
     if not os.path.exists(config['sdkmanager']):
@@ -122,10 +124,9 @@ def install_sdkmanager():
         '%s-%s.%s' % (archive.replace(".%s" % ext, ""),
                       sdkmanager['version'], ext))
     if not os.path.exists(archive_file):
-        url = DEVCIQ + 'sdk-manager/' + archive
+        url = endpoint('devciq', 'sdk-manager/' + archive)
         logger.info("Downloading '%s'" % url)
-        open(archive_file, "wb").write(requests.get(
-            url, verify=SSL_VERIFY).content)
+        download(url, archive_file)
     bin = os.path.join(config['sdkmanager'], 'bin', 'sdkmanager')
     if sys.platform.lower().startswith('darwin'):
         bin = os.path.join(config['sdkmanager'], 'SdkManager.app',
@@ -134,9 +135,7 @@ def install_sdkmanager():
         if ext == 'zip':
             logger.info("Extracting '%s' to '%s'." % (archive_file,
                                                 config['sdkmanager']))
-            zf = zipfile.ZipFile(archive_file)
-            zf.extractall(config['sdkmanager'])
-            os.chmod(bin, os.stat(bin).st_mode | stat.S_IEXEC)
+            extract(archive_file, config['sdkmanager'])
         if ext == 'dmg':
             logger.info("Extracting '%s' to '%s'." % (
                 archive_file, config['sdkmanager']))
@@ -168,20 +167,54 @@ def install_sdk():
         sys.exit(1)
 
 
-def get_available_sdks():
+def _read_catalog_cache():
+    return read_json(CATALOG_FILENAME, {})
+
+
+def _write_catalog_cache(cache):
+    write_json(CATALOG_FILENAME, cache)
+
+
+def _get_catalog(refresh=False):
+    url = endpoint('devciq', 'sdks/' + 'sdks.json')
+    cache = _read_catalog_cache()
+    if cache.get('url', url) != url:
+        cache = {}
+    ttl = int(read_config().get('catalog_ttl') or 0)
+    if (not refresh and 'sdks' in cache and
+            time.time() - cache.get('checked', 0) < ttl):
+        return cache['sdks']
+    import requests
+    headers = {}
+    if 'sdks' in cache:
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
+    try:
+        req = session().get(url, headers=headers)
+        if req.status_code != 304:
+            req.raise_for_status()
+            cache = {'url': url,
+                     'sdks': req.json(),
+                     'etag': req.headers.get('ETag'),
+                     'last_modified': req.headers.get(
+                         'Last-Modified',
+                         email.utils.formatdate(usegmt=True))}
+        cache['checked'] = time.time()
+        _write_catalog_cache(cache)
+    except (requests.RequestException, ValueError) as e:
+        if 'sdks' not in cache:
+            raise
+        logger.warning("Unable to refresh SDK catalog (%s), "
+                       "using cached copy." % e)
+    return cache['sdks']
+
+
+def get_available_sdks(refresh=False):
     sdks = {}
-    packages = {'linux': 'linux',
-                'windows': 'windows',
-                'darwin': 'mac'}
-    package = None
-    for _os, _package in packages.items():
-        if sys.platform.lower().startswith(_os):
-            package = _package
-    if not package:
-        raise Exception("Unable to find package of your OS: '%s'" %
-                        sys.platform)
-    for sdk in requests.get(DEVCIQ + 'sdks/' + 'sdks.json',
-                            verify=SSL_VERIFY).json():
+    package = platform_package()
+    for sdk in _get_catalog(refresh):
         package_name = sdk.get(package)
         if package_name:
             sdks[sdk['version']] = {'title': sdk['title'],
@@ -192,7 +225,7 @@ def get_available_sdks():
 
 def list_sdks():
     try:
-        sdks = get_available_sdks()
+        sdks = get_available_sdks(refresh='--refresh' in sys.argv[1:])
     except Exception as e:
         logger.error(str(e))
         sys.exit(1)
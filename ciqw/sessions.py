@@ -0,0 +1,164 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import time
+import signal
+import subprocess
+from ciqw.config import CONFIG_DIR, read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+# The monkeydo started for each project and device, so that a new run
+# replaces the previous one instead of piling up JVMs.
+SESSIONS_FILENAME = os.path.join(CONFIG_DIR, 'sessions.json')
+STOP_TIMEOUT = 5
+
+# Started by this process, to be reaped.
+_children = {}
+
+
+def _read_sessions():
+    return read_json(SESSIONS_FILENAME, {})
+
+
+def _write_sessions(sessions):
+    write_json(SESSIONS_FILENAME, sessions)
+
+
+def _group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _identity(pid):
+    # What tells the process 'pid' from a later one reusing its pid:
+    # the boot and its start time. None when it is gone or without
+    # /proc.
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # After the command name, which may hold spaces.
+            start = f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+    return "%s:%s" % (_boot_id(), start)
+
+
+def _owned(session):
+    # Whether the group of 'session' still is the one it started, and
+    # not one of another process that got the same pid after a reboot
+    # or once the whole group was gone.
+    if not os.path.isdir('/proc/self'):
+        return True
+    identity = session.get('identity')
+    if not identity:
+        return False
+    current = _identity(session['pid'])
+    if current is None:
+        # The leader exited, but the pid of a still living group is
+        # not reused: only the boot can tell.
+        return identity.split(':')[0] == str(_boot_id())
+    return current == identity
+
+
+def _alive(session):
+    # Each monkeydo leads its own process group, which lives as long
+    # as the JVM it starts, even once the script itself is gone.
+    return _owned(session) and _group_alive(session['pid'])
+
+
+def terminate(pid, process=None, timeout=STOP_TIMEOUT):
+    # Stops the process group led by 'pid' (a script and the JVM it
+    # started): SIGTERM, then SIGKILL what is left after 'timeout'
+    # seconds. 'process' is its Popen when it is our child, reaped
+    # here.
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(pid, sig)
+        except OSError:
+            break
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if (process is None or process.poll() is not None) and \
+               not _group_alive(pid):
+                return
+            time.sleep(0.05)
+    if process is not None:
+        process.poll()
+
+
+def _reap():
+    for pid, p in list(_children.items()):
+        if p.poll() is not None:
+            del _children[pid]
+
+
+def key(device, path='.'):
+    return "%s:%s" % (os.path.abspath(path), device)
+
+
+def _stop(session):
+    terminate(session['pid'], _children.get(session['pid']))
+    _reap()
+
+
+def stop(keys=None):
+    # Stops the sessions for 'keys', all of them by default, and
+    # returns those that were running.
+    sessions = _read_sessions()
+    stopped = {}
+    for k in list(sessions) if keys is None else keys:
+        session = sessions.pop(k, None)
+        if session and _alive(session):
+            _stop(session)
+            stopped[k] = session
+    _write_sessions(sessions)
+    return stopped
+
+
+def launch(k, command, env=None, **info):
+    stop([k])
+    logger.info("Calling '%s'." % " ".join(command))
+    p = subprocess.Popen(command, env=env, start_new_session=True)
+    _children[p.pid] = p
+    sessions = _read_sessions()
+    sessions[k] = dict(info, pid=p.pid, started=time.time(),
+                       identity=_identity(p.pid))
+    _write_sessions(sessions)
+    return p
+
+
+def status():
+    # The running sessions, forgetting those that ended.
+    _reap()
+    sessions = _read_sessions()
+    running = {k: s for k, s in sessions.items() if _alive(s)}
+    if running != sessions:
+        _write_sessions(running)
+    return running
@@ -0,0 +1,156 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import sys
+import stat
+import shutil
+import hashlib
+import tempfile
+from ciqw.config import read_config, read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+# Blobs are read only so an edit in one SDK can not leak into the
+# others sharing the same inode.
+BLOB_MODE = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+EXEC_MODE = BLOB_MODE | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+
+def _index_filename(store):
+    return os.path.join(store, 'index.json')
+
+
+def load_index(store):
+    return read_json(_index_filename(store), {})
+
+
+def update_index(store, entries):
+    if not entries:
+        return
+    index = load_index(store)
+    index.update(entries)
+    write_json(_index_filename(store), index)
+
+
+def index_key(info):
+    # Zip entries already carry size and CRC, so a file seen in a
+    # previous SDK at the same place is found without decompressing it.
+    return "%08x:%d:%s" % (info.CRC, info.file_size, info.filename)
+
+
+def blob_path(store, digest, executable):
+    return os.path.join(store, 'objects', digest[:2],
+                        digest[2:] + ('.x' if executable else ''))
+
+
+def add(store, src, executable):
+    tmp_dir = os.path.join(store, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    sha = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                sha.update(chunk)
+                dst.write(chunk)
+        digest = sha.hexdigest()
+        blob = blob_path(store, digest, executable)
+        if os.path.exists(blob):
+            os.unlink(tmp)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.chmod(tmp, EXEC_MODE if executable else BLOB_MODE)
+            os.replace(tmp, blob)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return digest
+
+
+def link(blob, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.lexists(path):
+        os.unlink(path)
+    try:
+        os.link(blob, path)
+    except OSError:
+        # Most likely not on the same filesystem than the store.
+        shutil.copy2(blob, path)
+
+
+def _walk_blobs(store):
+    objects = os.path.join(store, 'objects')
+    if not os.path.isdir(objects):
+        return
+    for prefix in os.scandir(objects):
+        if prefix.is_dir():
+            for blob in os.scandir(prefix.path):
+                yield blob
+
+
+def stats(store):
+    blobs = physical = logical = 0
+    for blob in _walk_blobs(store):
+        st = blob.stat()
+        blobs += 1
+        physical += st.st_size
+        logical += st.st_size * max(st.st_nlink - 1, 0)
+    return {'blobs': blobs, 'physical': physical, 'logical': logical,
+            'ratio': logical / physical if physical else 0}
+
+
+def gc(store):
+    removed = freed = 0
+    for blob in _walk_blobs(store):
+        st = blob.stat()
+        if st.st_nlink == 1:
+            os.unlink(blob.path)
+            removed += 1
+            freed += st.st_size
+    index = load_index(store)
+    kept = {}
+    for key, (digest, executable) in index.items():
+        if os.path.exists(blob_path(store, digest, executable)):
+            kept[key] = [digest, executable]
+    if len(kept) != len(index):
+        write_json(_index_filename(store), kept)
+    return removed, freed
+
+
+def sdk_store():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    store = read_config().get('store')
+    if not store:
+        logger.error("No 'store' configured in the ciqw configuration.")
+        sys.exit(1)
+    if command == 'stats':
+        s = stats(store)
+        logger.info("Blobs: %d" % s['blobs'])
+        logger.info("Stored: %.1f MiB" % (s['physical'] / 1048576.))
+        logger.info("Referenced by SDKs: %.1f MiB" % (
+            s['logical'] / 1048576.))
+        logger.info("Deduplication ratio: %.2f" % s['ratio'])
+    elif command == 'gc':
+        removed, freed = gc(store)
+        logger.info("Removed %d unreferenced blobs (%.1f MiB)." % (
+            removed, freed / 1048576.))
+    else:
+        logger.error("Usage: ciqw-sdk-store [stats|gc]")
+        sys.exit(1)
@@ -0,0 +1,126 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import re
+import time
+import threading
+import subprocess
+import xml.etree.ElementTree as ET
+from ciqw import sessions
+
+logger = logging.getLogger(__name__)
+
+# 'monkeydo <prg> <device> -t' prints, for each (:test) function:
+#
+# ------------------------------------------------------------------
+# Executing test MyAppTest.testSomething...
+# <whatever the test printed>
+# PASS|FAIL|ERROR
+# <failure details>
+#
+# and then a 'RESULTS' table we do not need.
+
+STATUSES = ('PASS', 'FAIL', 'ERROR')
+_EXECUTING = re.compile(r'^Executing test (.+?)\.*$')
+
+
+def parse_results(lines):
+    # 'lines' are (time, line) as monkeydo printed them; returns
+    # [{'name', 'status', 'time', 'output'}], a test without a status
+    # (crash, timeout) being an ERROR.
+    results = []
+    current = None
+    for t, line in lines:
+        line = line.rstrip('\r\n')
+        executing = _EXECUTING.match(line.strip())
+        if executing or line.startswith(('=====', 'RESULTS')):
+            if current and current['status'] is None:
+                current.update(status='ERROR', time=t - current['time'])
+            current = None
+        if executing:
+            current = {'name': executing.group(1), 'status': None,
+                       'time': t, 'output': []}
+            results.append(current)
+        elif current and line.startswith('-----'):
+            pass
+        elif current and current['status'] is None and \
+                line.strip() in STATUSES:
+            current.update(status=line.strip(), time=t - current['time'])
+        elif current:
+            current['output'].append(line)
+    if current and current['status'] is None:
+        current.update(status='ERROR', time=time.time() - current['time'])
+    return results
+
+
+def run(command, timeout, env=None, log=None):
+    # Runs monkeydo, killing it after 'timeout' seconds, and parses what
+    # it prints, copied to 'log'.
+    p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, env=env,
+                         start_new_session=True, universal_newlines=True)
+    timer = threading.Timer(timeout, sessions.terminate, (p.pid, p))
+    timer.start()
+    lines = []
+    try:
+        for line in p.stdout:
+            lines.append((time.time(), line))
+            if log:
+                log.write(line)
+        p.wait()
+    finally:
+        timer.cancel()
+    if p.returncode and p.returncode < 0:
+        lines.append((time.time(), "ERROR: monkeydo killed after %ss\n" %
+                      timeout))
+        if log:
+            log.write(lines[-1][1])
+    return parse_results(lines)
+
+
+def error(name, message):
+    # A result standing for what prevented the tests to run.
+    return {'name': name, 'status': 'ERROR', 'time': 0,
+            'output': [message]}
+
+
+def write_junit(filename, suites):
+    # 'suites' is [(device, results)].
+    root = ET.Element('testsuites')
+    for device, results in suites:
+        suite = ET.SubElement(root, 'testsuite', name=device,
+                              tests=str(len(results)))
+        for status, attr in (('FAIL', 'failures'), ('ERROR', 'errors')):
+            suite.set(attr, str(sum(r['status'] == status for r in results)))
+        suite.set('time', "%.3f" % sum(r['time'] for r in results))
+        for result in results:
+            case = ET.SubElement(suite, 'testcase', classname=device,
+                                 name=result['name'],
+                                 time="%.3f" % result['time'])
+            output = "\n".join(result['output'])
+            if result['status'] == 'FAIL':
+                ET.SubElement(case, 'failure', message='FAIL').text = output
+            elif result['status'] == 'ERROR':
+                ET.SubElement(case, 'error', message='ERROR').text = output
+            elif output:
+                ET.SubElement(case, 'system-out').text = output
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    ET.ElementTree(root).write(filename, encoding='utf-8',
+                               xml_declaration=True)
@@ -0,0 +1,80 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+# Spans recorded while a command runs, when 'CIQW_TRACE' names a file
+# (or with 'ciqw --trace FILE <command>'), written there in the Chrome
+# trace format (chrome://tracing, ui.perfetto.dev) and summed up on
+# stderr. Disabled, a span costs a test.
+
+_events = None
+_filename = None
+
+
+def enabled():
+    return _events is not None
+
+
+def setup(filename):
+    global _events, _filename
+    if filename:
+        _events = []
+        _filename = os.path.abspath(filename)
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    # 'args' are shown with the span, the body may add some (exit
+    # codes, sizes) to the dict it gets.
+    if _events is None:
+        yield args
+        return
+    start = time.time()
+    try:
+        yield args
+    finally:
+        _events.append({'name': name, 'ph': 'X', 'pid': os.getpid(),
+                        'tid': threading.get_ident(),
+                        'ts': int(start * 1e6),
+                        'dur': int((time.time() - start) * 1e6),
+                        'args': args})
+
+
+def write():
+    if _events is None:
+        return
+    events = list(_events)
+    tmp = "%s.%d.tmp" % (_filename, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    os.replace(tmp, _filename)
+    totals = {}
+    for e in events:
+        count, total, longest = totals.get(e['name'], (0, 0, 0))
+        totals[e['name']] = (count + 1, total + e['dur'],
+                             max(longest, e['dur']))
+    print("Trace written to '%s':" % _filename, file=sys.stderr)
+    for name, (count, total, longest) in sorted(
+            totals.items(), key=lambda i: -i[1][1]):
+        print("%24s %4dx %9.3fs (max %.3fs)" % (
+            name, count, total / 1e6, longest / 1e6), file=sys.stderr)
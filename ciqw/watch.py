@@ -0,0 +1,126 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Both backends watch the files directly in 'top' and everything below
+# the 'trees' directories, and yield the paths of the files written,
+# created, moved or deleted there.
+
+
+def _scan(directory):
+    entries = {}
+    try:
+        for entry in os.scandir(directory):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            entries[entry.name] = (entry.is_dir(follow_symlinks=False),
+                                   st.st_mtime_ns, st.st_size)
+    except OSError:
+        pass
+    return entries
+
+
+def _snapshot(top, trees):
+    snapshot = {top: _scan(top)}
+    for tree in trees:
+        for root, dirs, _files in os.walk(tree):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            snapshot[root] = _scan(root)
+    return snapshot
+
+
+def poll(top, trees, interval):
+    # Keeps the stat of every watched entry, one scandir per directory
+    # and per round; file changes do not show on the directory mtime
+    # so each directory has to be listed, but only the entries that
+    # differ are processed.
+    snapshot = _snapshot(top, trees)
+    while True:
+        time.sleep(interval)
+        for directory in list(snapshot):
+            if directory not in snapshot:
+                continue
+            before = snapshot[directory]
+            after = _scan(directory)
+            if after == before:
+                continue
+            snapshot[directory] = after
+            for name in set(before) | set(after):
+                old, new = before.get(name), after.get(name)
+                if old == new:
+                    continue
+                path = os.path.join(directory, name)
+                is_dir = (new or old)[0]
+                if not is_dir:
+                    yield path
+                elif directory != top and not name.startswith('.'):
+                    if new and not old:
+                        added = _snapshot(path, [path])
+                        snapshot.update(added)
+                        for root, entries in added.items():
+                            for f, (d, _m, _s) in entries.items():
+                                if not d:
+                                    yield os.path.join(root, f)
+                    elif old and not new:
+                        for d in [d for d in snapshot
+                                  if d == path or
+                                  d.startswith(path + os.sep)]:
+                            del snapshot[d]
+
+
+def _inotify(top, trees):
+    import inotify.adapters
+    i = inotify.adapters.Inotify()
+    i.add_watch(top)
+    for tree in trees:
+        for root, dirs, _files in os.walk(tree):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            i.add_watch(root)
+    return i
+
+
+def _inotify_events(i, top):
+    for _ev, types, path, filename in i.event_gen(yield_nones=False):
+        full = os.path.join(path, filename)
+        if 'IN_ISDIR' in types:
+            if path != top and 'IN_CREATE' in types:
+                i.add_watch(full)
+            continue
+        if any(t in types for t in ('IN_CLOSE_WRITE', 'IN_MOVED_TO',
+                                    'IN_MOVED_FROM', 'IN_DELETE')):
+            yield full
+
+
+def watch(top, trees, backend='auto', interval=1.0):
+    trees = [t for t in trees if os.path.isdir(t)]
+    if backend != 'poll':
+        try:
+            return _inotify_events(_inotify(top, trees), top)
+        except Exception as e:
+            # No module, not Linux, or no inotify watch left.
+            if backend == 'inotify':
+                raise
+            logger.info("Inotify unavailable (%s), polling every %ss." % (
+                e or e.__class__.__name__, interval))
+    return poll(top, trees, interval)
@@ -18,6 +18,7 @@
 from setuptools import setup
 
 console_scripts = """
+ciqw = ciqw:main
 ciqw-build = ciqw:build
 ciqw-auto = ciqw:auto
 ciqw-run = ciqw:run
@@ -29,12 +30,19 @@ ciqw-run-sdkmanager = ciqw:run_sdkmanager
 ciqw-init = ciqw:init
 ciqw-genkey = ciqw:genkey
 ciqw-sim = ciqw:sim
+ciqw-test = ciqw:test
 ciqw-login = ciqw:login
 ciqw-install-fonts-and-devices = ciqw:install_fonts_and_devices
 ciqw-list-devices = ciqw:list_devices
 ciqw-doc = ciqw:doc
 ciqw-samples = ciqw:samples
 ciqw-samples-path = ciqw:samples_path
+ciqw-sdk-store = ciqw:sdk_store
+ciqw-mirror = ciqw:mirror
+ciqw-cache = ciqw:cache
+ciqw-compile-server = ciqw:compile_server
+ciqw-optimize-sdk = ciqw:optimize_sdk
+ciqw-stats = ciqw:stats
 """
 
 setup(name='ciqw',
@@ -43,6 +51,7 @@ setup(name='ciqw',
       author="Jean Schurger",
       author_email='jean@schurger.org',
       packages=['ciqw'],
+      package_data={'ciqw': ['*.java']},
       entry_points={
           'console_scripts': console_scripts,
       },
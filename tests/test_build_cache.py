@@ -0,0 +1,170 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import os
+import sys
+import json
+import shutil
+import zipfile
+import threading
+import subprocess
+import http.server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_SDK = os.path.join(ROOT, 'tests', 'stub_sdk')
+
+MANIFEST = """<iq:manifest xmlns:iq="http://www.garmin.com/xml/connectiq">
+<iq:application entry="App" id="stub">
+<iq:products><iq:product id="fenix6"/></iq:products>
+</iq:application></iq:manifest>
+"""
+
+
+class Store(http.server.BaseHTTPRequestHandler):
+    # Stands for the shared HTTP store: GET and PUT of whole files.
+    blobs = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path))
+        data = self.blobs.get(self.path)
+        self.send_response(200 if data is not None else 404)
+        self.send_header('Content-Length', str(len(data or b'')))
+        self.end_headers()
+        self.wfile.write(data or b'')
+
+    def do_PUT(self):
+        self.requests.append(('PUT', self.path))
+        self.blobs[self.path] = self.rfile.read(
+            int(self.headers['Content-Length']))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _server():
+    Store.blobs, Store.requests = {}, []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Store)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _setup(tmp_path, store, readonly=False):
+    home = tmp_path / 'home'
+    sdk = home / 'sdks' / 'connectiq-sdk-lin-1.0.0-stub'
+    shutil.copytree(STUB_SDK, str(sdk))
+    (home / '.Garmin' / 'ConnectIQ' / 'Devices' / 'fenix6').mkdir(
+        parents=True)
+    (home / 'key.der').write_bytes(b'key')
+    ini = home / 'config.ini'
+    ini.write_text("[ciqw]\nsdks = %s\nversion = 1.0.0\nkey = %s\n"
+                   "build_cache_size = 10\nartifact_store = %s\n"
+                   "artifact_store_readonly = %s\n" % (
+                       home / 'sdks', home / 'key.der', store,
+                       'yes' if readonly else 'no'))
+    app = tmp_path / 'app'
+    (app / 'source').mkdir(parents=True)
+    (app / 'source' / 'App.mc').write_text("")
+    (app / 'manifest.xml').write_text(MANIFEST)
+    env = dict(os.environ, HOME=str(home), CIQW_INI=str(ini),
+               PYTHONPATH=ROOT, NO_PROXY='127.0.0.1')
+    return home, app, env
+
+
+def _build(app, env):
+    return subprocess.run(
+        [sys.executable, '-m', 'ciqw', 'build', '--devices', 'fenix6'],
+        cwd=str(app), env=env, capture_output=True, text=True, timeout=60)
+
+
+def _fresh_agent(home, app):
+    # Another machine: no local cache nor output, and a monkeyc that
+    # would fail if it were called.
+    shutil.rmtree(str(home / 'build-cache'))
+    shutil.rmtree(str(app / 'bin'))
+    monkeyc = home / 'sdks' / 'connectiq-sdk-lin-1.0.0-stub' / 'bin' / \
+        'monkeyc'
+    monkeyc.write_text("#!/bin/sh\necho monkeyc called\nexit 1\n")
+
+
+def _stats(home):
+    with open(str(home / 'build-cache' / 'stats.json')) as f:
+        return json.load(f)
+
+
+def test_http_store(tmp_path):
+    server = _server()
+    try:
+        home, app, env = _setup(tmp_path, 'http://127.0.0.1:%d/cache' %
+                                server.server_address[1])
+        result = _build(app, env)
+        assert result.returncode == 0, result.stderr
+        prg = (app / 'bin' / 'fenix6' / 'App.prg').read_bytes()
+        assert [m for m, _path in Store.requests] == ['GET', 'PUT']
+        assert _stats(home) == {'misses': 1, 'remote_misses': 1}
+
+        _fresh_agent(home, app)
+        result = _build(app, env)
+        assert result.returncode == 0, result.stderr
+        assert (app / 'bin' / 'fenix6' / 'App.prg').read_bytes() == prg
+        assert [m for m, _path in Store.requests] == ['GET', 'PUT', 'GET']
+        assert _stats(home) == {'misses': 1, 'remote_hits': 1}
+    finally:
+        server.shutdown()
+
+
+def test_http_store_readonly(tmp_path):
+    server = _server()
+    try:
+        home, app, env = _setup(tmp_path, 'http://127.0.0.1:%d/cache' %
+                                server.server_address[1], readonly=True)
+        result = _build(app, env)
+        assert result.returncode == 0, result.stderr
+        assert [m for m, _path in Store.requests] == ['GET']
+        assert not Store.blobs
+    finally:
+        server.shutdown()
+
+
+def test_directory_store(tmp_path):
+    store = tmp_path / 'store'
+    home, app, env = _setup(tmp_path, store)
+    result = _build(app, env)
+    assert result.returncode == 0, result.stderr
+    prg = (app / 'bin' / 'fenix6' / 'App.prg').read_bytes()
+    zips = list(store.glob('*/*.zip'))
+    assert len(zips) == 1
+    with zipfile.ZipFile(str(zips[0])) as zf:
+        assert zf.namelist() == ['output']
+
+    _fresh_agent(home, app)
+    result = _build(app, env)
+    assert result.returncode == 0, result.stderr
+    assert (app / 'bin' / 'fenix6' / 'App.prg').read_bytes() == prg
+    assert _stats(home) == {'misses': 1, 'remote_hits': 1}
+
+
+def test_directory_store_readonly(tmp_path):
+    store = tmp_path / 'store'
+    store.mkdir()
+    _home, app, env = _setup(tmp_path, store, readonly=True)
+    result = _build(app, env)
+    assert result.returncode == 0, result.stderr
+    assert list(store.iterdir()) == []
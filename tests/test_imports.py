@@ -0,0 +1,55 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Cumulative import time of 'ciqw' and 'ciqw.run', in microseconds;
+# they took about 10 ms once requests and pyquery became lazy, and
+# more than 100 ms before.
+BUDGET = 250000
+HEAVY = ('requests', 'pyquery', 'lxml', 'inotify', 'urllib3')
+
+
+def _python(code):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          env=env, capture_output=True, text=True,
+                          check=True)
+
+
+def test_no_heavy_module_at_import():
+    result = _python("import sys, ciqw, ciqw.run\n"
+                     "print(' '.join(sorted(sys.modules)))")
+    loaded = set(result.stdout.split())
+    assert not [m for m in HEAVY if m in loaded]
+
+
+def test_import_time_budget():
+    # The best of a few runs, to not fail on a busy machine.
+    times = []
+    for _ in range(3):
+        cumulative = 0
+        for line in _python("import ciqw, ciqw.run").stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() in ('ciqw',
+                                                          'ciqw.run'):
+                cumulative += int(fields[1])
+        times.append(cumulative)
+    assert min(times) < BUDGET, "%d us" % min(times)
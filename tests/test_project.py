@@ -0,0 +1,124 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import os
+import sys
+import json
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ciqw import project, build_cache  # noqa: E402
+
+PRODUCTS = ['fenix6', 'venu2', 'fr245']
+
+MANIFEST = """<iq:manifest xmlns:iq="http://www.garmin.com/xml/connectiq">
+<iq:application entry="App" id="stub"><iq:products>
+%s
+</iq:products></iq:application></iq:manifest>
+""" % "\n".join('<iq:product id="%s"/>' % p for p in PRODUCTS)
+
+JUNGLE = """# Sources moved, resources appended to.
+base.sourcePath = src
+base.resourcePath = $(base.resourcePath);extra-res
+venu2.sourcePath = $(base.sourcePath);src-venu2
+base.lang.fre = lang/fre
+"""
+
+FILES = ['src/App.mc', 'src-venu2/Amoled.mc', 'source/Unused.mc',
+         'resources/strings.xml', 'resources-fenix6/layout.xml',
+         'resources-venu2/layout.xml', 'resources-fr245/layout.xml',
+         'resources-round-260x260/bitmaps.xml',
+         'resources-416x416/bitmaps.xml', 'resources-fre/strings.xml',
+         'extra-res/more.xml', 'lang/fre/strings.xml']
+
+# fr245 is not installed: its family is unknown.
+DEVICES = {'fenix6': ('round-260x260', 'mip', 260),
+           'venu2': ('round-416x416', 'amoled', 416)}
+
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    home = tmp_path / 'home'
+    for device, (family, display, size) in DEVICES.items():
+        d = home / '.Garmin' / 'ConnectIQ' / 'Devices' / device
+        d.mkdir(parents=True)
+        (d / 'compiler.json').write_text(json.dumps({
+            'deviceFamily': family, 'displayType': display,
+            'resolution': {'width': size, 'height': size}}))
+    monkeypatch.setenv('HOME', str(home))
+    app = tmp_path / 'app'
+    for f in FILES:
+        (app / f).parent.mkdir(parents=True, exist_ok=True)
+        (app / f).write_text('')
+    (app / 'manifest.xml').write_text(MANIFEST)
+    (app / 'monkey.jungle').write_text(JUNGLE)
+    return str(app)
+
+
+def test_source_paths(path):
+    model = project.Project(path)
+    assert model.roots('fenix6')['sourcePath'] == ['src']
+    assert model.roots('venu2')['sourcePath'] == ['src', 'src-venu2']
+
+
+def test_resource_paths(path):
+    model = project.Project(path)
+    assert model.roots('fenix6')['resourcePath'] == [
+        'resources', 'extra-res', 'lang/fre', 'resources-fenix6',
+        'resources-fre', 'resources-round-260x260']
+    assert model.roots('venu2')['resourcePath'] == [
+        'resources', 'extra-res', 'lang/fre', 'resources-416x416',
+        'resources-fre', 'resources-venu2']
+    # Not installed: only other device names are ruled out.
+    assert model.roots('fr245')['resourcePath'] == [
+        'resources', 'extra-res', 'lang/fre', 'resources-416x416',
+        'resources-fr245', 'resources-fre', 'resources-round-260x260']
+
+
+def test_devices_for(path):
+    model = project.Project(path)
+    assert model.devices_for('resources-fenix6/layout.xml',
+                             PRODUCTS) == ['fenix6']
+    assert model.devices_for('resources-416x416/bitmaps.xml',
+                             PRODUCTS) == ['venu2', 'fr245']
+    assert model.devices_for('src-venu2/Amoled.mc', PRODUCTS) == ['venu2']
+    assert model.devices_for('source/Unused.mc', PRODUCTS) == []
+    assert model.devices_for('src/App.mc', PRODUCTS) == PRODUCTS
+    assert model.devices_for('lang/fre/strings.xml', PRODUCTS) == PRODUCTS
+    assert model.devices_for('monkey.jungle', PRODUCTS) == PRODUCTS
+
+
+def test_input_files(path):
+    common = ['extra-res/more.xml', 'lang/fre/strings.xml', 'manifest.xml',
+              'monkey.jungle', 'resources-fre/strings.xml',
+              'resources/strings.xml', 'src/App.mc']
+    fenix6 = build_cache.get_input_files(path, 'fenix6')
+    assert fenix6 == sorted(common + [
+        'resources-fenix6/layout.xml',
+        'resources-round-260x260/bitmaps.xml'])
+    venu2 = build_cache.get_input_files(path, 'venu2')
+    assert venu2 == sorted(common + [
+        'resources-416x416/bitmaps.xml', 'resources-venu2/layout.xml',
+        'src-venu2/Amoled.mc'])
+    # A release reads what every product does.
+    release = build_cache.get_input_files(path)
+    assert release == sorted(set(fenix6) | set(venu2) | set(
+        build_cache.get_input_files(path, 'fr245')))
+    assert 'source/Unused.mc' not in release
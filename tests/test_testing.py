@@ -0,0 +1,103 @@
+# This file is part of ciqw
+# Copyright (C) 2021  Jean Schurger
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import os
+import sys
+import shutil
+import signal
+import subprocess
+import xml.etree.ElementTree as ET
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_SDK = os.path.join(ROOT, 'tests', 'stub_sdk')
+sys.path.insert(0, ROOT)
+
+from ciqw import testing  # noqa: E402
+
+MANIFEST = """<iq:manifest xmlns:iq="http://www.garmin.com/xml/connectiq">
+<iq:application entry="App" id="stub">
+<iq:products><iq:product id="fenix6"/></iq:products>
+</iq:application></iq:manifest>
+"""
+
+
+def test_parse_results():
+    lines = ["-----", "Executing test A.testPass...", "PASS", "-----",
+             "Executing test A.testFail...", "DEBUG: 1 != 2", "FAIL",
+             "Failure: expected 2", "-----",
+             "Executing test A.testCrash...", "Error: Unhandled",
+             "=====", "RESULTS", "A.testPass    PASS"]
+    results = testing.parse_results((float(t), line + '\n')
+                                    for t, line in enumerate(lines))
+    assert [(r['name'], r['status']) for r in results] == [
+        ('A.testPass', 'PASS'), ('A.testFail', 'FAIL'),
+        ('A.testCrash', 'ERROR')]
+    assert results[0]['time'] == 1
+    assert results[1]['output'] == ['DEBUG: 1 != 2', 'Failure: expected 2']
+
+
+def test_ciqw_test_with_stub_sdk(tmp_path):
+    # A whole 'ciqw-test --junit' run, against the stub SDK: 'fenix6'
+    # builds and runs its tests, 'broken' does not build.
+    home = tmp_path / 'home'
+    sdks = home / 'sdks'
+    shutil.copytree(STUB_SDK, str(sdks / 'connectiq-sdk-lin-1.0.0-stub'))
+    for device in ('fenix6', 'broken'):
+        (home / '.Garmin' / 'ConnectIQ' / 'Devices' / device).mkdir(
+            parents=True)
+    (home / 'key.der').write_bytes(b'key')
+    ini = home / '.config' / 'ciqw' / 'config.ini'
+    ini.parent.mkdir(parents=True)
+    ini.write_text("[ciqw]\nsdks = %s\nversion = 1.0.0\nkey = %s\n"
+                   "build_cache_size = 0\nsim_timeout = 10\n" % (
+                       sdks, home / 'key.der'))
+    app = tmp_path / 'app'
+    (app / 'source').mkdir(parents=True)
+    (app / 'source' / 'App.mc').write_text("")
+    (app / 'manifest.xml').write_text(MANIFEST)
+    pids = tmp_path / 'pids'
+    env = dict(os.environ, HOME=str(home), CIQW_INI=str(ini),
+               PYTHONPATH=ROOT, CIQW_STUB_PIDS=str(pids))
+    # The simulator outlives the run: log to a file, not to a pipe it
+    # would hold open.
+    log = tmp_path / 'ciqw.log'
+    try:
+        with open(str(log), 'w') as out:
+            result = subprocess.run(
+                [sys.executable, '-m', 'ciqw', 'test', '--devices',
+                 'fenix6,broken', '--junit', 'junit.xml', '--timeout', '30'],
+                cwd=str(app), env=env, stdout=out, stderr=out, timeout=120)
+    finally:
+        if pids.exists():
+            for pid in pids.read_text().split():
+                try:
+                    os.kill(int(pid), signal.SIGTERM)
+                except OSError:
+                    pass
+    assert result.returncode == 1, log.read_text()
+    suites = {s.get('name'): s for s in
+              ET.parse(str(app / 'junit.xml')).getroot()}
+    fenix6 = suites['fenix6']
+    assert (fenix6.get('tests'), fenix6.get('failures'),
+            fenix6.get('errors')) == ('3', '1', '1')
+    failure = fenix6.find("testcase[@name='AppTest.testFail']/failure")
+    assert 'expected 2, got 1' in failure.text
+    assert fenix6.find("testcase[@name='AppTest.testCrash']/error") \
+        is not None
+    broken = suites['broken']
+    assert (broken.get('tests'), broken.get('errors')) == ('1', '1')
+    assert broken.find("testcase[@name='build']/error") is not None